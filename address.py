@@ -0,0 +1,116 @@
+import socket
+import struct
+from operator import itemgetter
+from typing import Dict, Iterable, List, Tuple, Union
+
+# tcp for peers and udp for the dht, one number so a single port forward covers both
+LISTEN_PORT = 52786
+COMPACT_V4 = struct.Struct('>4sH')
+COMPACT_V6 = struct.Struct('>16sH')
+
+class PeerAddress(tuple):
+    # (ip, port) as a plain tuple, so it hashes and compares like the address keys used everywhere else
+    __slots__ = ()
+
+    def __new__(cls, ip: str, port: int):
+        return tuple.__new__(cls, (ip, port))
+
+    ip = property(itemgetter(0))
+    port = property(itemgetter(1))
+
+    @property
+    def family(self) -> int:
+        return socket.AF_INET6 if ':' in self[0] else socket.AF_INET
+
+    def pack(self) -> bytes:
+        if self.family == socket.AF_INET6:
+            return COMPACT_V6.pack(socket.inet_pton(socket.AF_INET6, self[0]), self[1])
+        return COMPACT_V4.pack(socket.inet_aton(self[0]), self[1])
+
+    def __repr__(self):
+        return f'[{self[0]}]:{self[1]}' if ':' in self[0] else f'{self[0]}:{self[1]}'
+
+def toBytes(value: Union[bytes, str]) -> bytes:
+    # bcoding hands back byte strings that happen to be valid utf-8 as str, compact peer lists included
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+def unpackCompact(data: Union[bytes, str, memoryview], family: int = socket.AF_INET) -> List[PeerAddress]:
+    # BEP 23 peers (6 bytes each) or BEP 7 peers6 (18 bytes each), a trailing partial entry is dropped
+    entry = COMPACT_V6 if family == socket.AF_INET6 else COMPACT_V4
+    data = memoryview(toBytes(data))
+    data = data[:len(data) - len(data) % entry.size]
+    if family == socket.AF_INET6:
+        ntop = socket.inet_ntop
+        return [PeerAddress(ntop(socket.AF_INET6, ip), port) for ip, port in entry.iter_unpack(data) if port]
+    ntoa = socket.inet_ntoa
+    return [PeerAddress(ntoa(ip), port) for ip, port in entry.iter_unpack(data) if port]
+
+def packCompact(addresses: Iterable[PeerAddress]) -> bytes:
+    return b''.join(address.pack() for address in addresses)
+
+def parsePeers(response: Dict) -> Tuple[List[PeerAddress], Dict[PeerAddress, str]]:
+    # addresses out of a tracker response in any of its forms, plus the peer ids a non compact list carries
+    addresses = []
+    peer_ids = {}
+    peers = response.get('peers', b'')
+    if isinstance(peers, list):
+        for peer in peers:
+            try:
+                address = PeerAddress(toBytes(peer['ip']).decode('ascii'), int(peer['port']))
+            except (KeyError, TypeError, ValueError, UnicodeDecodeError):
+                continue
+            addresses.append(address)
+            if peer.get('peer id'):
+                peer_id = peer['peer id']
+                peer_ids[address] = peer_id.decode('utf-8', 'replace') if isinstance(peer_id, bytes) else peer_id
+    else:
+        addresses += unpackCompact(peers)
+    if response.get('peers6'):
+        addresses += unpackCompact(response['peers6'], socket.AF_INET6)
+    return addresses, peer_ids
+
+def mergePeers(peer_lists: Iterable[Iterable[PeerAddress]]) -> List[PeerAddress]:
+    # one pass over every list, first sighting wins so tracker order is kept
+    seen = set()
+    merged = []
+    for peers in peer_lists:
+        for address in peers:
+            if address not in seen:
+                seen.add(address)
+                merged.append(address)
+    return merged
+
+def benchmark(num_peers: int = 5000, num_trackers: int = 4, rounds: int = 5):
+    import time
+    import random
+    import ipaddress
+    rnd = random.Random(0)
+    swarm = [(rnd.getrandbits(32).to_bytes(4, 'big'), rnd.randrange(1, 65536)) for _ in range(num_peers)]
+    # every tracker knows a random half of the swarm
+    responses = [b''.join(COMPACT_V4.pack(ip, port) for ip, port in rnd.sample(swarm, num_peers // 2)) for _ in range(num_trackers)]
+
+    def old():
+        peers = []
+        for data in responses:
+            for chunk in [data[i:i+6] for i in range(0, len(data), 6)]:
+                peer = {'ip': str(ipaddress.IPv4Address(chunk[:4])), 'port': struct.unpack('>H', chunk[4:])[0]}
+                if peer not in peers:
+                    peers.append(peer)
+        return sorted((peer['ip'], peer['port']) for peer in peers)
+
+    def new():
+        return sorted(mergePeers(unpackCompact(data) for data in responses))
+
+    print(f'ADDRESS: {num_trackers} trackers x {num_peers // 2} compact peers, parse and merge')
+    results = {}
+    for name, run in (('dict+list', old), ('PeerAddress', new)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            results[name] = run()
+        print(f'ADDRESS: {name:11} {(time.perf_counter() - start) / rounds * 1e3:9.2f}ms')
+    assert results['dict+list'] == results['PeerAddress']
+    peers6 = packCompact([PeerAddress('2001:db8::1', 6881), PeerAddress('::ffff:10.0.0.1', 51413)])
+    print(f'ADDRESS: peers6 round trip {unpackCompact(peers6, socket.AF_INET6)}')
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,141 @@
+from typing import Iterable, Iterator
+
+# set bit positions of every byte value, most significant bit first like the wire format
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256))
+
+class Bitfield():
+    __slots__ = ('length', 'data', 'set_count')
+
+    def __init__(self, length: int):
+        self.length = length
+        self.data = bytearray((length + 7) // 8)
+        self.set_count = 0
+
+    @classmethod
+    def fromBytes(cls, data: bytes, length: int = None) -> 'Bitfield':
+        # wire bitfields are padded to whole bytes, spare bits past length are dropped
+        if length is None:
+            length = len(data) * 8
+        bitfield = cls(length)
+        size = len(bitfield.data)
+        bitfield.data[:] = bytes(data[:size]).ljust(size, b'\x00')
+        if length % 8:
+            bitfield.data[-1] &= (0xff << (8 - length % 8)) & 0xff
+        bitfield.set_count = bitfield.popcount()
+        return bitfield
+
+    @classmethod
+    def fromIndices(cls, indices: Iterable[int], length: int) -> 'Bitfield':
+        bitfield = cls(length)
+        for idx in indices:
+            bitfield.add(idx)
+        return bitfield
+
+    def tobytes(self) -> bytes:
+        return bytes(self.data)
+
+    def toInt(self) -> int:
+        return int.from_bytes(self.data, 'big')
+
+    def popcount(self) -> int:
+        return bin(self.toInt()).count('1')
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, idx: int) -> bool:
+        return 0 <= idx < self.length and bool(self.data[idx >> 3] & (0x80 >> (idx & 7)))
+
+    def __getitem__(self, idx: int) -> bool:
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        return bool(self.data[idx >> 3] & (0x80 >> (idx & 7)))
+
+    def __setitem__(self, idx: int, value: bool):
+        if value:
+            self.add(idx)
+        else:
+            self.discard(idx)
+
+    def add(self, idx: int):
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        mask = 0x80 >> (idx & 7)
+        if not self.data[idx >> 3] & mask:
+            self.data[idx >> 3] |= mask
+            self.set_count += 1
+
+    def discard(self, idx: int):
+        if not 0 <= idx < self.length:
+            return
+        mask = 0x80 >> (idx & 7)
+        if self.data[idx >> 3] & mask:
+            self.data[idx >> 3] &= ~mask & 0xff
+            self.set_count -= 1
+
+    def count(self) -> int:
+        # kept up to date by every mutation, so this is O(1)
+        return self.set_count
+
+    def any(self) -> bool:
+        return self.set_count > 0
+
+    def all(self) -> bool:
+        return self.set_count == self.length
+
+    def __iter__(self) -> Iterator[int]:
+        # set bit indices in order, whole zero bytes are skipped
+        for byte_idx, value in enumerate(self.data):
+            if value:
+                base = byte_idx << 3
+                for bit in BYTE_BITS[value]:
+                    yield base + bit
+
+    def andNot(self, other: 'Bitfield') -> 'Bitfield':
+        # bits set here but not in other, e.g. pieces a peer has that we lack
+        size = len(self.data)
+        mine = self.toInt()
+        theirs = int.from_bytes(bytes(other.data[:size]).ljust(size, b'\x00'), 'big')
+        return Bitfield.fromBytes((mine & ~theirs).to_bytes(size, 'big'), self.length)
+
+    def update(self, other: 'Bitfield'):
+        size = len(self.data)
+        merged = self.toInt() | int.from_bytes(bytes(other.data[:size]).ljust(size, b'\x00'), 'big')
+        self.data[:] = merged.to_bytes(size, 'big')
+        if self.length % 8:
+            self.data[-1] &= (0xff << (8 - self.length % 8)) & 0xff
+        self.set_count = self.popcount()
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.length == other.length and self.data == other.data
+
+    def __repr__(self):
+        return f'Bitfield({self.set_count}/{self.length})'
+
+def benchmark(num_pieces: int = 20000, rounds: int = 20):
+    import time
+    import random
+    indices = random.Random(0).sample(range(num_pieces), num_pieces // 2)
+    wire = Bitfield.fromIndices(indices, num_pieces).tobytes()
+    mine = Bitfield.fromIndices(indices[:num_pieces // 4], num_pieces)
+    mine_set = set(mine)
+    results = {}
+
+    def run(name, parse):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            lacking = parse()
+        results[name] = sorted(lacking)
+        print(f'BITFIELD: {name:9} {(time.perf_counter() - start) / rounds * 1e3:8.2f}ms')
+
+    print(f'BITFIELD: {num_pieces} pieces, parse a wire bitfield and list the pieces they have that we lack')
+    try:
+        import bitstring
+        run('bitstring', lambda: {idx for idx, have in enumerate(bitstring.BitArray(bytes=wire, length=num_pieces)) if have} - mine_set)
+    except ImportError:
+        pass
+    run('Bitfield', lambda: list(Bitfield.fromBytes(wire, num_pieces).andNot(mine)))
+    assert all(result == results['Bitfield'] for result in results.values())
+
+if __name__ == "__main__":
+    benchmark()
@@ -7,13 +7,45 @@ class State(Enum):
     PENDING = 1
     COMPLETE = 2
 
+MAX_POOLED_BYTES = 32 * 2**20
+
 class Block():
+    __slots__ = ('state', 'last_seen', 'size')
+
     def __init__(self, size=BLOCK_SIZE):
         self.state = State.FREE
         self.last_seen = 0
         self.size = size
-        self.data = b''
 
     def flush(self):
-        self.data = b''
         self.state = State.FREE
+
+class BufferPool():
+    def __init__(self, max_bytes=MAX_POOLED_BYTES):
+        # capped by bytes, a count cap would keep hundreds of MiB alive with large pieces
+        self.max_bytes = max_bytes
+        self.pooled_bytes = 0
+        self.buffers = {}
+
+    def acquire(self, size: int) -> bytearray:
+        free = self.buffers.get(size)
+        if free:
+            self.pooled_bytes -= size
+            return free.pop()
+        return bytearray(size)
+
+    def release(self, buffer: bytearray):
+        try:
+            # a buffer still exported as a memoryview (e.g. a block queued on a socket) must not be
+            # handed out again, resizing raises BufferError in exactly that case
+            buffer.append(0)
+            buffer.pop()
+        except BufferError:
+            return
+        if self.pooled_bytes + len(buffer) <= self.max_bytes:
+            self.buffers.setdefault(len(buffer), []).append(buffer)
+            self.pooled_bytes += len(buffer)
+
+    def clear(self):
+        self.buffers = {}
+        self.pooled_bytes = 0
@@ -0,0 +1,132 @@
+import time
+import asyncio
+from typing import Dict, Iterable, List, Tuple
+from address import PeerAddress
+
+TARGET_PEERS = 30
+MAX_DIALING = 8
+BASE_BACKOFF = 5
+MAX_BACKOFF = 600
+MAX_FAILURES = 6
+DEAD_AFTER = 120
+SLOW_PEER_GRACE = 60
+SLOW_PEER_RATE = 1024
+REPLACE_INTERVAL = 30
+MAINTAIN_INTERVAL = 1.0
+
+class Candidate():
+    __slots__ = ('ip', 'port', 'peer_id', 'failures', 'next_attempt')
+
+    def __init__(self, ip: str, port: int, peer_id='???'):
+        self.ip = ip
+        self.port = port
+        self.peer_id = peer_id
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def backoff(self, now: float):
+        self.failures += 1
+        self.next_attempt = now + min(BASE_BACKOFF * 2 ** (self.failures - 1), MAX_BACKOFF)
+
+class ConnectionManager():
+    def __init__(self, peer_manager, target: int = TARGET_PEERS, max_dialing: int = MAX_DIALING):
+        self.peer_manager = peer_manager
+        self.target = target
+        self.max_dialing = max_dialing
+        # (ip, port) -> Candidate, every address we know of whether it is connected or not
+        self.candidates: Dict[Tuple[str, int], Candidate] = {}
+        self.dialing: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.last_replace = time.time()
+        self.wakeup = asyncio.Event()
+
+    def addCandidates(self, addresses: Iterable[PeerAddress], peer_ids: Dict[PeerAddress, str] = None):
+        peer_ids = peer_ids or {}
+        for address in addresses:
+            candidate = self.candidates.get(address)
+            if candidate is None:
+                self.candidates[address] = Candidate(address.ip, address.port, peer_ids.get(address, '???'))
+            elif address in peer_ids and candidate.peer_id == '???':
+                candidate.peer_id = peer_ids[address]
+        self.wakeup.set()
+
+    def connectedAddresses(self) -> set:
+        return {(peer.ip, peer.port) for peer in self.peer_manager.peer_list}
+
+    def readyCandidates(self, now: float) -> List[Candidate]:
+        connected = self.connectedAddresses()
+        ready = [candidate for address, candidate in self.candidates.items()
+                 if candidate.next_attempt <= now and address not in connected and address not in self.dialing]
+        # addresses that never failed go first
+        ready.sort(key=lambda candidate: candidate.failures)
+        return ready
+
+    def onDisconnect(self, peer):
+        candidate = self.candidates.get((peer.ip, peer.port))
+        if candidate:
+            candidate.backoff(time.time())
+        self.wakeup.set()
+
+    async def dial(self, candidate: Candidate):
+        address = (candidate.ip, candidate.port)
+        try:
+            peer = self.peer_manager.createPeer(candidate.ip, candidate.port, candidate.peer_id)
+            await peer.connect()
+            if peer.isHealthy() and self.peer_manager.attachPeer(peer):
+                candidate.failures = 0
+            else:
+                # a refused or failed handshake still holds an open socket
+                if peer.writer:
+                    peer.writer.close()
+                candidate.backoff(time.time())
+                if candidate.failures >= MAX_FAILURES:
+                    self.candidates.pop(address, None)
+        finally:
+            del self.dialing[address]
+            self.wakeup.set()
+
+    def pruneDead(self):
+        for peer in self.peer_manager.connectedPeers():
+            if peer.timeout == float('inf') or peer.time_span - peer.timeout > DEAD_AFTER:
+                print(f'CONN_MAN: dropping dead peer {peer.ip}:{peer.port}')
+                self.peer_manager.removePeer(peer)
+
+    def replaceSlow(self, now: float):
+        # while leeching, a full connection set swaps its slowest settled peer for a fresh candidate
+        if now - self.last_replace < REPLACE_INTERVAL or not self.peer_manager.downloading:
+            return
+        if len(self.peer_manager.peer_list) < self.target or not self.readyCandidates(now):
+            return
+        self.last_replace = now
+        settled = [peer for peer in self.peer_manager.peer_list if now - peer.connected_at >= SLOW_PEER_GRACE]
+        if not settled:
+            return
+        slowest = min(settled, key=lambda peer: peer.download_rate.getRate())
+        if slowest.download_rate.getRate() < SLOW_PEER_RATE:
+            print(f'CONN_MAN: replacing slow peer {slowest.ip}:{slowest.port}')
+            self.peer_manager.removePeer(slowest)
+
+    def maintain(self):
+        now = time.time()
+        self.pruneDead()
+        self.replaceSlow(now)
+        free = self.target - len(self.peer_manager.peer_list) - len(self.dialing)
+        for candidate in self.readyCandidates(now)[:min(free, self.max_dialing - len(self.dialing))]:
+            task = asyncio.create_task(self.dial(candidate))
+            self.dialing[(candidate.ip, candidate.port)] = task
+
+    async def fill(self):
+        # dials until the connected set is at target or nothing is left to try right now
+        while True:
+            self.maintain()
+            if not self.dialing:
+                return
+            await asyncio.wait(list(self.dialing.values()), return_when=asyncio.FIRST_COMPLETED)
+
+    async def run(self, interval: float = MAINTAIN_INTERVAL):
+        while True:
+            self.maintain()
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
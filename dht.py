@@ -0,0 +1,507 @@
+import os
+import time
+import random
+import socket
+import struct
+import asyncio
+import hashlib
+from typing import Callable, Dict, List, Optional, Tuple
+from bcoding import bencode, bdecode
+from address import LISTEN_PORT, PeerAddress, toBytes, unpackCompact
+
+K = 8
+ALPHA = 3
+ID_BITS = 160
+QUERY_TIMEOUT = 2.0
+MAX_NODE_FAILURES = 2
+NODE_STALE_AFTER = 15 * 60
+BUCKET_REFRESH = 15 * 60
+TOKEN_ROTATE = 5 * 60
+PEER_TTL = 30 * 60
+MAX_VALUES = 50
+MAX_STORED_PEERS = 2000
+ANNOUNCE_INTERVAL = 15 * 60
+SAVE_INTERVAL = 5 * 60
+DHT_STATE_PATH = 'dht.state'
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881)]
+
+NODE_INFO = struct.Struct('>20s4sH')
+TRANSACTION_ID = struct.Struct('>H')
+
+ERROR_PROTOCOL = 203
+ERROR_METHOD = 204
+
+def idToInt(node_id: bytes) -> int:
+    return int.from_bytes(node_id, 'big')
+
+def randomId(lo: int = 0, hi: int = 2 ** ID_BITS) -> bytes:
+    return random.randrange(lo, hi).to_bytes(20, 'big')
+
+class Node():
+    __slots__ = ('id', 'value', 'address', 'last_seen', 'failures')
+
+    def __init__(self, node_id: bytes, address: PeerAddress):
+        self.id = node_id
+        # the id as an int, xor of two of these is the kademlia distance
+        self.value = idToInt(node_id)
+        self.address = address
+        self.last_seen = time.time()
+        self.failures = 0
+
+    def isBad(self) -> bool:
+        return self.failures >= MAX_NODE_FAILURES
+
+    def isStale(self, now: float) -> bool:
+        return now - self.last_seen > NODE_STALE_AFTER
+
+    def pack(self) -> bytes:
+        return NODE_INFO.pack(self.id, socket.inet_aton(self.address.ip), self.address.port)
+
+    def __repr__(self):
+        return f'{self.id.hex()[:8]}@{self.address}'
+
+def unpackNodes(data) -> List[Node]:
+    # BEP 5 compact node info, 20 byte id + 6 byte compact address each
+    data = memoryview(toBytes(data))
+    data = data[:len(data) - len(data) % NODE_INFO.size]
+    return [Node(bytes(node_id), PeerAddress(socket.inet_ntoa(ip), port)) for node_id, ip, port in NODE_INFO.iter_unpack(data) if port]
+
+class Bucket():
+    __slots__ = ('lo', 'hi', 'nodes', 'last_changed')
+
+    def __init__(self, lo: int, hi: int):
+        # covers ids in [lo, hi), nodes are ordered least recently seen first
+        self.lo = lo
+        self.hi = hi
+        self.nodes: Dict[bytes, Node] = {}
+        self.last_changed = time.time()
+
+    def covers(self, value: int) -> bool:
+        return self.lo <= value < self.hi
+
+    def touch(self, node: Node):
+        self.nodes.pop(node.id, None)
+        self.nodes[node.id] = node
+        self.last_changed = time.time()
+
+class RoutingTable():
+    def __init__(self, node_id: bytes):
+        self.node_id = node_id
+        self.value = idToInt(node_id)
+        self.buckets = [Bucket(0, 2 ** ID_BITS)]
+
+    def bucketFor(self, value: int) -> Bucket:
+        # buckets stay sorted by range, there are at most 160 of them
+        for bucket in self.buckets:
+            if bucket.covers(value):
+                return bucket
+
+    def get(self, node_id: bytes) -> Optional[Node]:
+        return self.bucketFor(idToInt(node_id)).nodes.get(node_id)
+
+    def insert(self, node: Node) -> bool:
+        if node.id == self.node_id:
+            return False
+        bucket = self.bucketFor(node.value)
+        known = bucket.nodes.get(node.id)
+        if known:
+            known.address = node.address
+            known.last_seen = time.time()
+            known.failures = 0
+            bucket.touch(known)
+            return True
+        if len(bucket.nodes) < K:
+            bucket.touch(node)
+            return True
+        # only the bucket holding our own id is split, far away space keeps K nodes per bucket
+        if bucket.covers(self.value) and bucket.hi - bucket.lo > K:
+            self.split(bucket)
+            return self.insert(node)
+        bad = next((other for other in bucket.nodes.values() if other.isBad()), None)
+        if bad:
+            del bucket.nodes[bad.id]
+            bucket.touch(node)
+            return True
+        return False
+
+    def split(self, bucket: Bucket):
+        middle = (bucket.lo + bucket.hi) // 2
+        low, high = Bucket(bucket.lo, middle), Bucket(middle, bucket.hi)
+        for node in bucket.nodes.values():
+            (low if node.value < middle else high).nodes[node.id] = node
+        idx = self.buckets.index(bucket)
+        self.buckets[idx:idx + 1] = [low, high]
+
+    def markFailed(self, node_id: bytes):
+        node = self.get(node_id)
+        if node:
+            node.failures += 1
+
+    def closest(self, target: bytes, count: int = K) -> List[Node]:
+        value = idToInt(target)
+        nodes = [node for bucket in self.buckets for node in bucket.nodes.values() if not node.isBad()]
+        nodes.sort(key=lambda node: node.value ^ value)
+        return nodes[:count]
+
+    def staleNodes(self, now: float) -> List[Node]:
+        return [node for bucket in self.buckets for node in bucket.nodes.values() if node.isStale(now)]
+
+    def staleBuckets(self, now: float) -> List[Bucket]:
+        return [bucket for bucket in self.buckets if now - bucket.last_changed > BUCKET_REFRESH]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def pack(self) -> bytes:
+        return b''.join(node.pack() for bucket in self.buckets for node in bucket.nodes.values() if not node.isBad())
+
+class DHTNode(asyncio.DatagramProtocol):
+    def __init__(self, node_id: bytes = None, state_path: Optional[str] = DHT_STATE_PATH,
+                 bootstrap_nodes: List[Tuple[str, int]] = None, query_timeout: float = QUERY_TIMEOUT):
+        self.state_path = state_path
+        self.bootstrap_nodes = BOOTSTRAP_NODES if bootstrap_nodes is None else bootstrap_nodes
+        self.query_timeout = query_timeout
+        self.saved_nodes: List[Node] = []
+        # a persisted node keeps its id and starts from the nodes it knew last time
+        self.node_id = node_id
+        if node_id is None and not self.load():
+            self.node_id = os.urandom(20)
+        self.table = RoutingTable(self.node_id)
+        self.transport: asyncio.DatagramTransport = None
+        self.port = None
+        self.pending: Dict[bytes, asyncio.Future] = {}
+        self.next_transaction = random.getrandbits(16)
+        # tokens are a hash of the asking ip and a secret that rotates, the previous secret is still honoured
+        self.secrets = [os.urandom(8), os.urandom(8)]
+        self.last_rotate = time.time()
+        # info hash -> address -> time of the announce
+        self.peers: Dict[bytes, Dict[PeerAddress, float]] = {}
+        self.last_save = time.time()
+
+    async def start(self, host: str = '0.0.0.0', port: int = LISTEN_PORT):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+        self.pending.clear()
+
+    def error_received(self, exc):
+        # icmp errors can't be tied to a query, it just times out
+        pass
+
+    def load(self) -> bool:
+        if not self.state_path:
+            return False
+        try:
+            with open(self.state_path, 'rb') as f:
+                record = bdecode(f)
+            node_id = bytes.fromhex(record['id'])
+            saved_nodes = unpackNodes(bytes.fromhex(record['nodes']))
+        except Exception:
+            return False
+        if len(node_id) != 20:
+            return False
+        self.node_id, self.saved_nodes = node_id, saved_nodes
+        return True
+
+    def save(self):
+        if not self.state_path:
+            return
+        # binary fields are stored as hex like the resume data, bdecode would hand valid utf-8 back as str
+        record = {'id': self.node_id.hex(), 'nodes': self.table.pack().hex()}
+        tmp_path = self.state_path + '.tmp'
+        if os.path.dirname(self.state_path):
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode(record))
+        os.replace(tmp_path, self.state_path)
+        self.last_save = time.time()
+
+    def token(self, ip: str, secret: bytes = None) -> bytes:
+        self.rotateSecrets()
+        return hashlib.sha1((secret or self.secrets[0]) + socket.inet_aton(ip)).digest()[:8]
+
+    def rotateSecrets(self):
+        now = time.time()
+        if now - self.last_rotate > TOKEN_ROTATE:
+            self.secrets = [os.urandom(8), self.secrets[0]]
+            self.last_rotate = now
+
+    def validToken(self, token: bytes, ip: str) -> bool:
+        return any(token == self.token(ip, secret) for secret in self.secrets)
+
+    def send(self, message: Dict, addr):
+        if self.transport and not self.transport.is_closing():
+            self.transport.sendto(bencode(message), addr)
+
+    def error(self, transaction_id: bytes, code: int, text: str, addr):
+        self.send({'t': transaction_id, 'y': 'e', 'e': [code, text]}, addr)
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            message = bdecode(data)
+            kind = message['y']
+            transaction_id = toBytes(message['t'])
+        except Exception:
+            return
+        address = PeerAddress(addr[0], addr[1])
+        if kind == 'q':
+            self.handleQuery(message, transaction_id, address)
+        elif kind in ('r', 'e'):
+            future = self.pending.pop(transaction_id, None)
+            if future is None or future.done():
+                return
+            if kind == 'r' and isinstance(message.get('r'), dict):
+                future.set_result(message['r'])
+            else:
+                future.set_result(None)
+
+    def handleQuery(self, message: Dict, transaction_id: bytes, address: PeerAddress):
+        try:
+            method = message['q']
+            args = message['a']
+            sender = toBytes(args['id'])
+        except Exception:
+            return self.error(transaction_id, ERROR_PROTOCOL, 'malformed query', address)
+        if len(sender) != 20:
+            return self.error(transaction_id, ERROR_PROTOCOL, 'bad node id', address)
+        self.table.insert(Node(sender, address))
+        response = {'id': self.node_id}
+        try:
+            if method == 'ping':
+                pass
+            elif method == 'find_node':
+                response['nodes'] = b''.join(node.pack() for node in self.table.closest(toBytes(args['target'])))
+            elif method == 'get_peers':
+                info_hash = toBytes(args['info_hash'])
+                response['token'] = self.token(address.ip)
+                values = self.storedPeers(info_hash)
+                if values:
+                    response['values'] = [value.pack() for value in values]
+                else:
+                    response['nodes'] = b''.join(node.pack() for node in self.table.closest(info_hash))
+            elif method == 'announce_peer':
+                info_hash = toBytes(args['info_hash'])
+                if not self.validToken(toBytes(args['token']), address.ip):
+                    return self.error(transaction_id, ERROR_PROTOCOL, 'bad token', address)
+                port = address.port if args.get('implied_port') else args['port']
+                # a stored port that does not pack would break every get_peers for this swarm
+                if not isinstance(port, int) or not 0 < port < 65536:
+                    return self.error(transaction_id, ERROR_PROTOCOL, 'bad port', address)
+                self.storePeer(info_hash, PeerAddress(address.ip, port))
+            else:
+                return self.error(transaction_id, ERROR_METHOD, 'method unknown', address)
+        except (KeyError, TypeError, ValueError):
+            return self.error(transaction_id, ERROR_PROTOCOL, 'missing argument', address)
+        self.send({'t': transaction_id, 'y': 'r', 'r': response}, address)
+
+    def storePeer(self, info_hash: bytes, address: PeerAddress):
+        swarm = self.peers.setdefault(info_hash, {})
+        swarm.pop(address, None)
+        swarm[address] = time.time()
+        if len(swarm) > MAX_STORED_PEERS:
+            del swarm[next(iter(swarm))]
+
+    def storedPeers(self, info_hash: bytes) -> List[PeerAddress]:
+        swarm = self.peers.get(info_hash)
+        if not swarm:
+            return []
+        # announces are kept in arrival order, so expired ones sit at the front
+        expire = time.time() - PEER_TTL
+        while swarm and next(iter(swarm.values())) < expire:
+            del swarm[next(iter(swarm))]
+        values = list(swarm)
+        return random.sample(values, MAX_VALUES) if len(values) > MAX_VALUES else values
+
+    async def query(self, address: Tuple[str, int], method: str, args: Dict, node_id: bytes = None) -> Optional[Dict]:
+        self.next_transaction = (self.next_transaction + 1) & 0xffff
+        transaction_id = TRANSACTION_ID.pack(self.next_transaction)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        args['id'] = self.node_id
+        self.send({'t': transaction_id, 'y': 'q', 'q': method, 'a': args}, address)
+        try:
+            response = await asyncio.wait_for(future, self.query_timeout)
+        except asyncio.TimeoutError:
+            response = None
+        finally:
+            self.pending.pop(transaction_id, None)
+        try:
+            sender = toBytes(response['id'])
+        except (KeyError, TypeError):
+            sender = None
+        if response is None or sender is None or len(sender) != 20:
+            if node_id:
+                self.table.markFailed(node_id)
+            return None
+        self.table.insert(Node(sender, PeerAddress(address[0], address[1])))
+        response['id'] = sender
+        return response
+
+    def addNode(self, address: PeerAddress):
+        # a peer told us its dht port, it joins the table once it answers a ping
+        asyncio.ensure_future(self.query(address, 'ping', {}))
+
+    async def lookup(self, target: bytes, method: str = 'find_node',
+                     on_peers: Callable[[List[PeerAddress]], None] = None) -> Tuple[List[Tuple[Node, bytes]], List[PeerAddress]]:
+        # iterative kademlia lookup, ALPHA queries in flight, done once the K closest nodes seen have all answered or failed;
+        # returns those nodes with the token each handed out, and every peer found on the way
+        value = idToInt(target)
+        key = 'info_hash' if method == 'get_peers' else 'target'
+        candidates: Dict[bytes, Node] = {node.id: node for node in self.table.closest(target)}
+        queried = set()
+        answered: Dict[bytes, Tuple[Node, bytes]] = {}
+        peers: Dict[PeerAddress, None] = {}
+        inflight: Dict[asyncio.Future, Node] = {}
+        if not candidates:
+            await self.bootstrap()
+            candidates = {node.id: node for node in self.table.closest(target)}
+        while True:
+            closest = sorted(candidates.values(), key=lambda node: node.value ^ value)[:K]
+            for node in closest:
+                if len(inflight) >= ALPHA:
+                    break
+                if node.id not in queried:
+                    queried.add(node.id)
+                    inflight[asyncio.ensure_future(self.query(node.address, method, {key: target}, node.id))] = node
+            if not inflight:
+                break
+            done, _ = await asyncio.wait(list(inflight), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                node = inflight.pop(future)
+                response = future.result()
+                if response is None:
+                    candidates.pop(node.id, None)
+                    continue
+                answered[node.id] = (node, toBytes(response.get('token', b'')))
+                for found in unpackNodes(response.get('nodes', b'')):
+                    if found.id != self.node_id and found.id not in candidates and found.id not in queried:
+                        candidates[found.id] = found
+                values = response.get('values')
+                if isinstance(values, list):
+                    new_peers = [address for raw in values for address in unpackCompact(raw) if address not in peers]
+                    peers.update(dict.fromkeys(new_peers))
+                    if new_peers and on_peers:
+                        on_peers(new_peers)
+        closest = sorted(answered.values(), key=lambda item: item[0].value ^ value)[:K]
+        return closest, list(peers)
+
+    async def bootstrap(self):
+        # nodes saved from the last run first, the public routers only when none of them answer
+        saved, self.saved_nodes = self.saved_nodes, []
+        await asyncio.gather(*(self.query(node.address, 'find_node', {'target': self.node_id}) for node in saved))
+        if len(self.table) == 0:
+            addresses = []
+            for host, port in self.bootstrap_nodes:
+                try:
+                    infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                except OSError:
+                    print(f'DHT: cannot resolve bootstrap node {host}:{port}')
+                    continue
+                addresses.append(infos[0][4])
+            await asyncio.gather(*(self.query(address, 'find_node', {'target': self.node_id}) for address in addresses))
+        if len(self.table):
+            await self.lookup(self.node_id)
+            # the self lookup only fills the near buckets, one lookup into every other range reaches the far ones
+            now = time.time()
+            far = [bucket for bucket in self.table.buckets if not bucket.covers(self.table.value)]
+            for bucket in far:
+                bucket.last_changed = now
+            await asyncio.gather(*(self.lookup(randomId(bucket.lo, bucket.hi)) for bucket in far))
+        print(f'DHT: bootstrapped with {len(self.table)} nodes')
+
+    async def getPeers(self, info_hash: bytes, on_peers: Callable[[List[PeerAddress]], None] = None) -> List[PeerAddress]:
+        _, peers = await self.lookup(info_hash, 'get_peers', on_peers)
+        return peers
+
+    async def announce(self, info_hash: bytes, port: int, on_peers: Callable[[List[PeerAddress]], None] = None) -> List[PeerAddress]:
+        closest, peers = await self.lookup(info_hash, 'get_peers', on_peers)
+        await asyncio.gather(*(self.query(node.address, 'announce_peer', {'info_hash': info_hash, 'port': port, 'token': token}, node.id)
+                               for node, token in closest if token))
+        return peers
+
+    async def refresh(self):
+        now = time.time()
+        await asyncio.gather(*(self.query(node.address, 'ping', {}, node.id) for node in self.table.staleNodes(now)))
+        for bucket in self.table.staleBuckets(now):
+            bucket.last_changed = now
+            await self.lookup(randomId(bucket.lo, bucket.hi))
+        if now - self.last_save > SAVE_INTERVAL:
+            self.save()
+
+    async def run(self, info_hash: bytes, on_peers: Callable[[List[PeerAddress]], None], port: int = LISTEN_PORT,
+                  interval: float = ANNOUNCE_INTERVAL):
+        # peers reach the caller as each node hands them out, not at the end of the lookup
+        await self.bootstrap()
+        while True:
+            peers = await self.announce(info_hash, port, on_peers)
+            print(f'DHT: {len(peers)} peers for {info_hash.hex()[:8]} from {len(self.table)} nodes')
+            self.save()
+            next_announce = time.time() + interval
+            while time.time() < next_announce:
+                await asyncio.sleep(min(BUCKET_REFRESH / 3, max(next_announce - time.time(), 0)))
+                await self.refresh()
+
+async def simulate(num_nodes: int = 50, num_peers: int = 5, seed: int = 0) -> Tuple[int, int]:
+    import tempfile
+    # a loopback swarm: every node bootstraps off the first one, a few announce a torrent, a fresh node looks it up
+    rnd = random.Random(seed)
+    random.seed(seed)
+    nodes = [DHTNode(rnd.randbytes(20), state_path=None, bootstrap_nodes=[], query_timeout=0.5) for _ in range(num_nodes)]
+    for node in nodes:
+        await node.start('127.0.0.1', 0)
+    seed = ('127.0.0.1', nodes[0].port)
+    start = time.perf_counter()
+    for node in nodes[1:]:
+        node.bootstrap_nodes = [seed]
+    await asyncio.gather(*(node.bootstrap() for node in nodes[1:]))
+    sizes = sorted(len(node.table) for node in nodes)
+    print(f'DHT_SIM: {num_nodes} nodes bootstrapped in {(time.perf_counter() - start) * 1e3:.0f}ms, table sizes {sizes[0]}..{sizes[-1]}')
+    info_hash = rnd.randbytes(20)
+    announcers = rnd.sample(nodes[1:], num_peers)
+    await asyncio.gather(*(node.announce(info_hash, 6881 + i) for i, node in enumerate(announcers)))
+    stored = sum(1 for node in nodes if node.peers.get(info_hash))
+    print(f'DHT_SIM: {num_peers} nodes announced, {stored} nodes store the swarm')
+
+    state_path = os.path.join(tempfile.mkdtemp(), DHT_STATE_PATH)
+    searcher = DHTNode(rnd.randbytes(20), state_path=state_path, bootstrap_nodes=[seed], query_timeout=0.5)
+    await searcher.start('127.0.0.1', 0)
+    start = time.perf_counter()
+    first = []
+    peers = await searcher.getPeers(info_hash, lambda found: first or first.append(time.perf_counter() - start))
+    expected = {PeerAddress('127.0.0.1', 6881 + i) for i in range(num_peers)}
+    print(f'DHT_SIM: cold lookup found {len(peers)}/{num_peers} peers, first after {first[0] * 1e3:.0f}ms, '
+          f'done in {(time.perf_counter() - start) * 1e3:.0f}ms, correct={set(peers) == expected}')
+    searcher.save()
+    searcher.close()
+    found = len(set(peers) & expected)
+
+    # a restart reloads its id and nodes from disk and gets going without the bootstrap router
+    nodes[0].close()
+    restarted = DHTNode(state_path=state_path, bootstrap_nodes=[], query_timeout=0.5)
+    await restarted.start('127.0.0.1', 0)
+    saved = len(restarted.saved_nodes)
+    start = time.perf_counter()
+    peers = await restarted.getPeers(info_hash)
+    found_restarted = len(set(peers) & expected)
+    print(f'DHT_SIM: restart from {saved} saved nodes, id kept={restarted.node_id == searcher.node_id}, '
+          f'found {len(peers)}/{num_peers} peers in {(time.perf_counter() - start) * 1e3:.0f}ms without the router')
+    restarted.close()
+    for node in nodes[1:]:
+        node.close()
+    return found, found_restarted
+
+if __name__ == "__main__":
+    found, found_restarted = asyncio.run(simulate())
+    assert found == found_restarted == 5, (found, found_restarted)
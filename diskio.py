@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+from storage import Storage
+
+DISK_WORKERS = 2
+MAX_QUEUED_BYTES = 64 * 2**20
+MAX_RUN_PIECES = 64
+
+class DiskWriter():
+    def __init__(self, storage: Storage, max_workers: int = DISK_WORKERS, max_queued_bytes: int = MAX_QUEUED_BYTES):
+        self.storage = storage
+        self.max_queued_bytes = max_queued_bytes
+        self.max_workers = max_workers
+        self.executor = None
+        self.queue: List[Tuple[int, bytes]] = []
+        self.queued_bytes = 0
+        self.inflight = 0
+        self.has_work = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue) + self.inflight
+
+    def isBackpressured(self) -> bool:
+        return self.queued_bytes >= self.max_queued_bytes
+
+    async def waitWritable(self):
+        while self.isBackpressured():
+            self.writable.clear()
+            await self.writable.wait()
+
+    async def put(self, piece_idx: int, data: bytes):
+        await self.waitWritable()
+        self.queue.append((piece_idx, data))
+        self.queued_bytes += len(data)
+        self.has_work.set()
+
+    def close(self):
+        self.closed = True
+        self.has_work.set()
+
+    def reopen(self):
+        # a run() that already returned has to be started again by the caller
+        self.closed = False
+
+    def coalesce(self, batch: List[Tuple[int, bytes]]) -> List[List[Tuple[int, bytes]]]:
+        runs = []
+        for piece_idx, data in sorted(batch, key=lambda item: item[0]):
+            if runs and runs[-1][-1][0] + 1 == piece_idx and len(runs[-1]) < MAX_RUN_PIECES:
+                runs[-1].append((piece_idx, data))
+            else:
+                runs.append([(piece_idx, data)])
+        return runs
+
+    def writeRun(self, run: List[Tuple[int, bytes]]):
+        self.storage.writeRun(run[0][0], 0, [data for _, data in run])
+
+    async def run(self, on_written: Callable[[int, bool], None]):
+        loop = asyncio.get_running_loop()
+        # the pool lives as long as run(), a writer reopened after close gets a fresh one
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='disk')
+        while True:
+            if not self.queue:
+                if self.closed:
+                    break
+                self.has_work.clear()
+                await self.has_work.wait()
+                continue
+            runs = self.coalesce(self.queue)
+            self.inflight = len(self.queue)
+            self.queue = []
+            results = await asyncio.gather(
+                *[loop.run_in_executor(self.executor, self.writeRun, run) for run in runs],
+                return_exceptions=True
+            )
+            self.inflight = 0
+            for run, result in zip(runs, results):
+                if isinstance(result, Exception):
+                    print(f'DISK: error writing pieces {run[0][0]}-{run[-1][0]}: {result}')
+                for piece_idx, data in run:
+                    self.queued_bytes -= len(data)
+                    on_written(piece_idx, not isinstance(result, Exception))
+            if not self.isBackpressured():
+                self.writable.set()
+        self.executor.shutdown(wait=False)
+        self.executor = None
@@ -1,49 +1,96 @@
 import asyncio
-from dumper import dump
 from torrent import Torrent
-from tracker import Tracker, TrackerManager, PEER_ID
-from peer import PeerManager
+from tracker import TrackerManager, PEER_ID
+from peer import PeerManager, UPLOAD_SLOTS, MAX_PEER
 from piece import PieceManager
+from dht import DHTNode
+from address import LISTEN_PORT
 
 class TorrentClient():
-    def __init__(self, torrent: str):
+    def __init__(self, torrent: str, streaming=False, file_priorities=None, upload_slots=UPLOAD_SLOTS,
+                 upload_limit=None, download_limit=None, use_dht=True):
         self.torrent = Torrent(torrent)
-        self.tracker_manager = TrackerManager(self.torrent)
-        self.piece_manager = PieceManager(self.torrent)
-        self.peer_manager = PeerManager(self.torrent.getInfoHash(), PEER_ID, self.piece_manager)
+        self.piece_manager = PieceManager(self.torrent, file_priorities)
+        self.piece_manager.setStreaming(streaming)
+        self.peer_manager = PeerManager(self.torrent.getInfoHash(), PEER_ID, self.piece_manager, upload_slots=upload_slots,
+                                        upload_limit=upload_limit, download_limit=download_limit)
+        self.tracker_manager = TrackerManager(self.torrent, self.trackerCounters)
+        self.tracker_task = None
+        # trackerless peer discovery, also what keeps us going when every tracker is down
+        self.dht = DHTNode() if use_dht else None
+        self.dht_task = None
         self.leech_task = None
-        self.seed_task = None
+        self.filesaver_task = None
+        self.piece_manager.on_reopen = self.resumeDownload
+        self.choke_task = None
+        self.connection_task = None
 
     async def main(self):
+        try:
+            await self.run()
+        finally:
+            # the resume record is written on the way out, whatever ended the run
+            self.close()
+
+    def close(self):
+        self.piece_manager.close()
+
+    async def run(self):
+        self.choke_task = asyncio.create_task(self.peer_manager.runChoker())
+        # peers are dialed as each tracker tier answers instead of after the slowest one
+        self.tracker_task = asyncio.create_task(self.tracker_manager.run(self.peer_manager.connections.addCandidates))
+        if self.dht:
+            await self.startDHT()
         if not self.piece_manager.isComplete():
-            await self.tracker_manager.requestPeers()
-            peers = self.tracker_manager.getPeersOnly()
-            await self.peer_manager.addPeers(peers)
+            self.connection_task = asyncio.create_task(self.peer_manager.connections.run())
             self.leech_task = asyncio.create_task(self.peer_manager.download())
-            self.seed_task = asyncio.create_task(self.peer_manager.handleRequests())
             self.filesaver_task = asyncio.create_task(self.piece_manager.writePiece())
             while self.peer_manager.downloading:
                 await asyncio.sleep(2)
+                if len(self.peer_manager.peer_list) < MAX_PEER // 2:
+                    self.tracker_manager.reannounce()
                 # dump(self.peer_manager)
                 self.displayDownloadProgress()
             await self.tracker_manager.sendCompleted()
         print(f'DOWNLOAD FOR {self.torrent.torrent_file} HAS COMPLETED!')
         print('------SEEDING START------')
         await self.openServer()
-        self.refresh_tracker_task = asyncio.create_task(self.refreshTrackers())
         while self.peer_manager.seeding:
             await asyncio.sleep(2)
             self.displayUploadProgress()
     
-    async def refreshTrackers(self):
-        while True:
-            await asyncio.sleep(30)
-            await self.tracker_manager.requestPeers()
-            peers = self.tracker_manager.getPeersOnly()
-            # await self.peer_manager.addPeers(peers)
+    def setFilePriority(self, file_idx, priority):
+        self.piece_manager.setFilePriority(file_idx, priority)
+
+    def resumeDownload(self):
+        # a file was unskipped after the download finished, the tasks that ended with it start again
+        if self.filesaver_task is None or self.filesaver_task.done():
+            self.filesaver_task = asyncio.create_task(self.piece_manager.writePiece())
+        if self.leech_task is None or self.leech_task.done():
+            self.leech_task = asyncio.create_task(self.peer_manager.download())
+        if self.connection_task is None or self.connection_task.done():
+            self.connection_task = asyncio.create_task(self.peer_manager.connections.run())
+        asyncio.create_task(self.peer_manager.resumeDownload())
+
+    def seek(self, byte_offset):
+        self.piece_manager.seek(byte_offset)
+
+    async def startDHT(self):
+        try:
+            await self.dht.start(port=LISTEN_PORT)
+        except OSError as e:
+            print(f'DHT: cannot listen on udp port {LISTEN_PORT}: {e}')
+            self.dht = None
+            return
+        self.peer_manager.dht = self.dht
+        self.dht_task = asyncio.create_task(self.dht.run(self.torrent.getInfoHash(), self.peer_manager.connections.addCandidates, LISTEN_PORT))
+
+    def trackerCounters(self):
+        left = self.torrent.getSize() - self.piece_manager.completed_size
+        return self.peer_manager.seeded, self.peer_manager.downloaded, max(left, 0)
 
     async def openServer(self):
-        self.server = await asyncio.start_server(self.peer_manager.serveClientConnect, '127.0.0.1', 52786)
+        self.server = await asyncio.start_server(self.peer_manager.serveClientConnect, '127.0.0.1', LISTEN_PORT)
         self.server_task = asyncio.create_task(self.server.serve_forever())
         print(f'SERVER STARTED! {self.server.is_serving()}')
 
@@ -87,4 +134,7 @@ class TorrentClient():
 if __name__ == "__main__":
     client = TorrentClient('sintel.torrent')
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(client.main())
\ No newline at end of file
+    try:
+        loop.run_until_complete(client.main())
+    except KeyboardInterrupt:
+        client.close()
\ No newline at end of file
@@ -1,10 +1,22 @@
 import struct
-import bitstring
+from bitfield import Bitfield
+from typing import Iterable, Iterator, Tuple
 
 HANDSHAKE_RESERVED = b'\x00' * 8
+# BEP 5: last reserved bit set means we run a dht node and take Port messages
+DHT_RESERVED = b'\x00' * 7 + b'\x01'
 HANDSHAKE_PSTR = b'BitTorrent protocol'
 HANDSHAKE_PSTRLEN = len(HANDSHAKE_PSTR)
 
+# precompiled layouts, every message starts with a 4 byte length and a 1 byte id
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>IB')
+HANDSHAKE = struct.Struct(f'>B{HANDSHAKE_PSTRLEN}s8s20s20s')
+HAVE = struct.Struct('>IBI')
+BLOCK_REQUEST = struct.Struct('>IBIII')
+PIECE_HEADER = struct.Struct('>IBII')
+PORT = struct.Struct('>IBH')
+
 class WrongMessageException(Exception):
     pass
 
@@ -18,132 +30,125 @@ class Message():
 
     @staticmethod
     def determineMessage(payload):
-        try:
-            _, message_id = struct.unpack('>IB', payload[:5])
-        except:
+        if len(payload) < HEADER.size:
             print('MESSAGES: Unpack message error')
             return None
-        
-        translate_id = {
-            0: Choke,
-            1: UnChoke,
-            2: Interested,
-            3: NotInterested,
-            4: Have,
-            5: BitField,
-            6: Request,
-            7: Piece,
-            8: Cancel,
-            9: Port
-        }
-
-        if message_id not in translate_id:
+        decoder = DECODERS.get(payload[4])
+        if decoder is None:
             raise WrongMessageException("Message Type not supported!")
-        return translate_id[message_id].readMessage(payload)
+        return decoder(payload)
+
+class MessageFramer():
+    length_prefix = struct.Struct('>I')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def feed(self, data: bytes):
+        # consumed bytes are dropped lazily, only once they make up most of the buffer
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset > len(self.buffer) // 2:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def messages(self) -> Iterator[memoryview]:
+        # yields each complete message, length prefix included, as a view that is only valid until the next one
+        while len(self) >= 4:
+            msg_len = self.length_prefix.unpack_from(self.buffer, self.offset)[0]
+            total_length = msg_len + 4
+            if len(self) < total_length:
+                return
+            with memoryview(self.buffer) as buffer_view:
+                view = buffer_view[self.offset : self.offset+total_length]
+                self.offset += total_length
+                try:
+                    yield view
+                finally:
+                    view.release()
 
 class Handshake(Message):
 
-    def __init__(self, peer_id, info_hash: bytes):
+    def __init__(self, peer_id, info_hash: bytes, reserved: bytes = HANDSHAKE_RESERVED):
         if isinstance(peer_id, str):
             peer_id = peer_id.encode()
         self.peer_id: bytes = peer_id
         self.info_hash: bytes = info_hash
+        self.reserved: bytes = reserved
     
     def writeMessage(self) -> bytes:
-        return struct.pack(f'>B{HANDSHAKE_PSTRLEN}s8s20s20s',
-            HANDSHAKE_PSTRLEN,
-            HANDSHAKE_PSTR,
-            HANDSHAKE_RESERVED,
-            self.info_hash,
-            self.peer_id
-        )
+        return HANDSHAKE.pack(HANDSHAKE_PSTRLEN, HANDSHAKE_PSTR, self.reserved, self.info_hash, self.peer_id)
+
+    def supportsDHT(self) -> bool:
+        return bool(self.reserved[7] & 0x01)
     
     @classmethod
     def readMessage(cls, payload):
-        pstrlen = struct.unpack('>B', payload[:1])[0]
-        pstr, reserved, info_hash, peer_id = struct.unpack(f'>{pstrlen}s8s20s20s', payload[1:49+pstrlen])
-        if pstr != HANDSHAKE_PSTR:
+        pstrlen, pstr, reserved, info_hash, peer_id = HANDSHAKE.unpack_from(payload)
+        if pstrlen != HANDSHAKE_PSTRLEN or pstr != HANDSHAKE_PSTR:
             raise WrongMessageException('Wrong Handshake protocol!')
-        return cls(peer_id, info_hash)
+        return cls(peer_id, info_hash, reserved)
 
 class KeepAlive(Message):
     msg_len = 0
 
     total_bytes = 4
+    encoded = LENGTH.pack(0)
 
     def writeMessage(self) -> bytes:
-        return struct.pack('>I', self.msg_len)
+        return self.encoded
     
     @classmethod
     def readMessage(cls, payload):
-        payload_len = struct.unpack('>I', payload[:cls.total_bytes])[0]
-        if payload_len != cls.msg_len:
+        if LENGTH.unpack_from(payload)[0] != cls.msg_len:
             raise WrongMessageException("Not a keep-alive messsage!")
-        return cls()
-    
-class Choke(Message):
+        return KEEP_ALIVE
+
+class FixedMessage(Message):
+    # messages without a payload are the same 5 bytes every time, so they are encoded
+    # once per class and decoding hands back one shared instance
     msg_len = 1
-    msg_id = 0
+    msg_id = None
 
     total_bytes = 5
+    encoded = b''
+    instance = None
 
-    def writeMessage(self) -> bytes:
-        return struct.pack('>IB', self.msg_len, self.msg_id)
-    
-    @classmethod
-    def readMessage(cls, payload):
-        payload_len, payload_id = struct.unpack('>IB', payload[:cls.total_bytes])
-        if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not a Choke message!")
-        return cls()
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.encoded = HEADER.pack(cls.msg_len, cls.msg_id)
+        cls.instance = cls()
 
-class UnChoke(Message):
-    msg_len = 1
-    msg_id = 1
+    def writeMessage(self) -> bytes:
+        return self.encoded
 
-    total_bytes = 5
+    def writeInto(self, buffer, offset: int) -> int:
+        buffer[offset:offset+self.total_bytes] = self.encoded
+        return offset + self.total_bytes
 
-    def writeMessage(self) -> bytes:
-        return struct.pack('>IB', self.msg_len, self.msg_id)
-    
     @classmethod
     def readMessage(cls, payload):
-        payload_len, payload_id = struct.unpack('>IB', payload[:cls.total_bytes])
-        if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not an UnChoke message!")
-        return cls()
+        if HEADER.unpack_from(payload) != (cls.msg_len, cls.msg_id):
+            raise WrongMessageException(f"Not a {cls.__name__} message!")
+        return cls.instance
 
-class Interested(Message):
-    msg_len = 1
-    msg_id = 2
-    
-    total_bytes = 5
+class Choke(FixedMessage):
+    msg_id = 0
 
-    def writeMessage(self) -> bytes:
-        return struct.pack('>IB', self.msg_len, self.msg_id)
-    
-    @classmethod
-    def readMessage(cls, payload):
-        payload_len, payload_id = struct.unpack('>IB', payload[:cls.total_bytes])
-        if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not an Interested message!")
-        return cls()
+class UnChoke(FixedMessage):
+    msg_id = 1
 
-class NotInterested(Message):
-    msg_len = 1
-    msg_id = 3
-    
-    total_bytes = 4
+class Interested(FixedMessage):
+    msg_id = 2
 
-    def writeMessage(self) -> bytes:
-        return struct.pack('>IB', self.msg_len, self.msg_id)
-    
-    @classmethod
-    def readMessage(cls, payload):
-        payload_len, payload_id = struct.unpack('>IB', payload[:cls.total_bytes])
-        if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not an NotInterested message!")
-        return cls()
+class NotInterested(FixedMessage):
+    msg_id = 3
 
 class Have(Message):
     msg_len = 5
@@ -155,11 +160,15 @@ class Have(Message):
         self.piece_idx = piece_idx
 
     def writeMessage(self) -> bytes:
-        return struct.pack('>IBI', self.msg_len, self.msg_id, self.piece_idx)
+        return HAVE.pack(self.msg_len, self.msg_id, self.piece_idx)
+
+    def writeInto(self, buffer, offset: int) -> int:
+        HAVE.pack_into(buffer, offset, self.msg_len, self.msg_id, self.piece_idx)
+        return offset + self.total_bytes
     
     @classmethod
     def readMessage(cls, payload):
-        payload_len, payload_id, payload_idx = struct.unpack('>IBI', payload[:cls.total_bytes])
+        payload_len, payload_id, payload_idx = HAVE.unpack_from(payload)
         if (payload_len != cls.msg_len or payload_id != cls.msg_id):
             raise WrongMessageException("Not a Have message!")
         return cls(payload_idx)
@@ -173,21 +182,21 @@ class BitField(Message):
         self.total_bytes = 4 + self.msg_len
 
     def writeMessage(self) -> bytes:
-        return struct.pack(f'>IB{len(self.bitfield.tobytes())}s', self.msg_len, self.msg_id, self.bitfield.tobytes())
+        return HEADER.pack(self.msg_len, self.msg_id) + self.bitfield.tobytes()
     
     @classmethod
     def readMessage(cls, payload):
-        payload_len, payload_id = struct.unpack('>IB', payload[:5])
-        payload_bitfield_raw = struct.unpack(f'>{payload_len-1}s', payload[5:5+payload_len-1])[0]
+        payload_len, payload_id = HEADER.unpack_from(payload)
         if payload_id != cls.msg_id:
             raise WrongMessageException("Not a BitField message!")
-        payload_bitfield = bitstring.BitArray(bytes=bytes(payload_bitfield_raw))
+        payload_bitfield = Bitfield.fromBytes(payload[5:4+payload_len])
         return cls(payload_bitfield)
 
-class Request(Message):
+class BlockMessage(Message):
+    # Request and Cancel share the same idx, begin, length layout
     msg_len = 13
-    msg_id = 6
-    
+    msg_id = None
+
     total_bytes = 17
 
     def __init__(self, idx, begin, length):
@@ -196,18 +205,37 @@ class Request(Message):
         self.length = length
 
     def __eq__(self, rhs):
-        return isinstance(rhs, Request) and self.idx == rhs.idx and self.begin == rhs.begin and self.length == rhs.length
+        return type(rhs) is type(self) and self.idx == rhs.idx and self.begin == rhs.begin and self.length == rhs.length
+
+    def __hash__(self):
+        return hash((self.msg_id, self.idx, self.begin, self.length))
 
     def writeMessage(self) -> bytes:
-        return struct.pack('>IBIII', self.msg_len, self.msg_id, self.idx, self.begin, self.length)
+        return BLOCK_REQUEST.pack(self.msg_len, self.msg_id, self.idx, self.begin, self.length)
+
+    def writeInto(self, buffer, offset: int) -> int:
+        BLOCK_REQUEST.pack_into(buffer, offset, self.msg_len, self.msg_id, self.idx, self.begin, self.length)
+        return offset + self.total_bytes
+
+    @classmethod
+    def writeBatch(cls, blocks: Iterable[Tuple[int, int, int]]) -> bytearray:
+        # packs a run of (idx, begin, length) into one preallocated buffer for a single socket write
+        blocks = list(blocks)
+        buffer = bytearray(cls.total_bytes * len(blocks))
+        for offset, (idx, begin, length) in zip(range(0, len(buffer), cls.total_bytes), blocks):
+            BLOCK_REQUEST.pack_into(buffer, offset, cls.msg_len, cls.msg_id, idx, begin, length)
+        return buffer
     
     @classmethod
     def readMessage(cls, payload):
-        payload_len, payload_id, payload_idx, payload_begin, payload_length = struct.unpack('>IBIII', payload[:cls.total_bytes])
+        payload_len, payload_id, payload_idx, payload_begin, payload_length = BLOCK_REQUEST.unpack_from(payload)
         if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not a Request message!")
+            raise WrongMessageException(f"Not a {cls.__name__} message!")
         return cls(payload_idx, payload_begin, payload_length)
 
+class Request(BlockMessage):
+    msg_id = 6
+
 class Piece(Message):
     msg_id = 7
 
@@ -220,73 +248,68 @@ class Piece(Message):
         self.total_bytes = 4 + self.msg_len
 
     def writeMessage(self) -> bytes:
-        return struct.pack(f'>IBII{self.block_length}s', self.msg_len, self.msg_id, self.idx, self.begin, self.block)
+        return self.writeHeader(self.idx, self.begin, self.block_length) + self.block
+
+    @classmethod
+    def writeHeader(cls, idx, begin, block_length) -> bytes:
+        # the 13 bytes in front of a block, so the block itself can be written without copying it into a message
+        return PIECE_HEADER.pack(9 + block_length, cls.msg_id, idx, begin)
     
     @classmethod
     def readMessage(cls, payload):
-        payload_block_length = len(payload) - 13
-        payload_len, payload_id, payload_idx, payload_begin, payload_block = struct.unpack(f'>IBII{payload_block_length}s', payload[:13 + payload_block_length])
+        payload_len, payload_id, payload_idx, payload_begin = PIECE_HEADER.unpack_from(payload)
         if payload_id != cls.msg_id:
             raise WrongMessageException("Not a Piece message!")
-        return cls(payload_idx, payload_begin, payload_block, payload_block_length)
+        # the framer reuses its buffer, so the block is copied out exactly once here
+        payload_block = bytes(payload[PIECE_HEADER.size:4+payload_len])
+        return cls(payload_idx, payload_begin, payload_block, len(payload_block))
 
-class Cancel(Message):
-    msg_len = 13
+class Cancel(BlockMessage):
     msg_id = 8
-    total_bytes = 17
-
-    def __init__(self, idx, begin, length):
-        self.idx = idx
-        self.begin = begin
-        self.length = length
-
-    def writeMessage(self) -> bytes:
-        return struct.pack('>IBIII', self.msg_len, self.msg_id, self.idx, self.begin, self.length)
-    
-    @classmethod
-    def readMessage(cls, payload):
-        payload_len, payload_id, payload_idx, payload_begin, payload_length = struct.unpack('>IBIII', payload[:cls.total_bytes])
-        if (payload_len != cls.msg_len or payload_id != cls.msg_id):
-            raise WrongMessageException("Not a Cancel message!")
-        return cls(payload_idx, payload_begin, payload_length)
     
 class Port(Message):
     msg_len = 3
     msg_id = 9
     
-    total_bytes = 9
+    total_bytes = 7
 
     def __init__(self, port):
         self.port = port
 
     def writeMessage(self) -> bytes:
-        return struct.pack('>IBI', self.msg_len, self.msg_id, self.port)
+        return PORT.pack(self.msg_len, self.msg_id, self.port)
     
     @classmethod
     def readMessage(cls, payload):
-        payload_len, payload_id, payload_port = struct.unpack('>IBI', payload[:cls.total_bytes])
+        payload_len, payload_id, payload_port = PORT.unpack_from(payload)
         if (payload_len != cls.msg_len or payload_id != cls.msg_id):
             raise WrongMessageException("Not a Port message!")
         return cls(payload_port)
 
+KEEP_ALIVE = KeepAlive()
+
+DECODERS = {msg_cls.msg_id: msg_cls.readMessage for msg_cls in (
+    Choke, UnChoke, Interested, NotInterested, Have, BitField, Request, Piece, Cancel, Port
+)}
+
+def benchmark(rounds: int = 200000):
+    import timeit
+    samples = [
+        Choke(), UnChoke(), Interested(), NotInterested(), Have(1234),
+        BitField(Bitfield(1500)), Request(5, 2**14, 2**14),
+        Piece(5, 2**14, bytes(2**14), 2**14), Cancel(5, 2**14, 2**14), Port(6881)
+    ]
+    for sample in samples:
+        name = type(sample).__name__
+        encoded = sample.writeMessage()
+        payload = memoryview(encoded)
+        encode_time = timeit.timeit(sample.writeMessage, number=rounds)
+        decode_time = timeit.timeit(lambda: Message.determineMessage(payload), number=rounds)
+        print(f'MESSAGES: {name:13} {len(encoded):6}B encode {encode_time / rounds * 1e9:8.0f}ns decode {decode_time / rounds * 1e9:8.0f}ns')
+    blocks = [(5, begin, 2**14) for begin in range(0, 2**20, 2**14)]
+    batch_time = timeit.timeit(lambda: Request.writeBatch(blocks), number=rounds // 10)
+    join_time = timeit.timeit(lambda: b''.join(Request(*block).writeMessage() for block in blocks), number=rounds // 10)
+    print(f'MESSAGES: {len(blocks)} requests batch {batch_time / (rounds // 10) * 1e6:.2f}us joined {join_time / (rounds // 10) * 1e6:.2f}us')
+
 if __name__ == "__main__":
-    from dumper import dump
-    from torrent import Torrent
-    torrent = Torrent('sintel.torrent')
-    handshake = Handshake('SISTER-g5mmig2atmetn', torrent.getInfoHash()).writeMessage()
-    read_handshake = Handshake.readMessage(handshake)
-    interested = Interested().writeMessage()
-    read_interested = Message.determineMessage(interested)
-    request = Request(5, 105, 2**14).writeMessage()
-    read_request = Message.determineMessage(request)
-    dump(handshake)
-    dump(read_handshake)
-    print(type(read_handshake))
-    print('-----------------------------------')
-    dump(interested)
-    dump(read_interested)
-    print(type(read_interested))
-    print('-----------------------------------')
-    dump(request)
-    dump(read_request)
-    print(type(read_request))
\ No newline at end of file
+    benchmark()
@@ -1,178 +1,311 @@
+import os
+import math
+import struct
 import time
 import random
-import struct
 import asyncio
-from bitstring import BitArray
+from collections import OrderedDict
+from bitfield import Bitfield
+from address import PeerAddress
 from typing import List, Dict
 import messages
 from piece import PieceManager
 from block import BLOCK_SIZE
 from dumper import dump
+from util import RateMeter
+from connection import ConnectionManager
+from ratelimit import TokenBucket, RateLimiter, GLOBAL_UPLOAD, GLOBAL_DOWNLOAD, FRAGMENT_SIZE
 
 MAX_RETRY = 3
 MAX_PEER = 30
+STREAM_FAST_PEERS = 4
 INFINITE = float('inf')
+MIN_QUEUE_DEPTH = 4
+MAX_QUEUE_DEPTH = 128
+QUEUE_MARGIN = 2
+MIN_MAINTENANCE_INTERVAL = 0.05
+MAINTENANCE_INTERVAL = 1.0
+MAX_UPLOAD_QUEUE = 500
+USE_SENDFILE = hasattr(os, 'sendfile')
+UPLOAD_SLOTS = 4
+CHOKE_INTERVAL = 10
+OPTIMISTIC_INTERVAL = 30
 
 class PeerManager():
-    def __init__(self, info_hash, peer_id: str, piece_manager: PieceManager):
+    def __init__(self, info_hash, peer_id: str, piece_manager: PieceManager, use_sendfile=USE_SENDFILE, upload_slots=UPLOAD_SLOTS,
+                 upload_limit=None, download_limit=None, peer_upload_limit=None, peer_download_limit=None):
         self.peer_list = []
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.piece_manager = piece_manager
-        self.downloadable_peers = asyncio.Queue()
-        self.requesting_peers = asyncio.Queue()
-        self.cancelled_requests = []
+        self.inflight = {}
         self.choked_peer = []
         self.seeding = True
         self.seeded = 0
+        # payload bytes received, reported to trackers with seeded as uploaded
+        self.downloaded = 0
+        self.use_sendfile = use_sendfile
+        # inbound connections served by serveClientConnect, choked and unchoked like peer_list
+        self.inbound_peers = []
+        self.upload_slots = upload_slots
+        self.optimistic = None
+        self.connections = ConnectionManager(self, target=MAX_PEER)
+        # set by the client when a dht node runs, peers then learn its port from us and we learn theirs
+        self.dht = None
+        # limits in bytes per second, None is unlimited; the global ones live in ratelimit
+        self.upload_bucket = TokenBucket(upload_limit)
+        self.download_bucket = TokenBucket(download_limit)
+        self.peer_upload_limit = peer_upload_limit
+        self.peer_download_limit = peer_download_limit
 
     @property
     def downloading(self):
         return not self.piece_manager.isComplete()
 
-    async def addPeers(self, raw_peers):
-        if raw_peers[0].get('peer id'):
-            peers = [Peer(self, raw_peer['ip'], raw_peer['port'], raw_peer['peer id']) for raw_peer in raw_peers]
-        else:
-            peers = [Peer(self, raw_peer['ip'], raw_peer['port']) for raw_peer in raw_peers]
-        connectPeersTasks = [peer.connect() for peer in peers]
-        for res in asyncio.as_completed(connectPeersTasks):
-            peer = await res
-            if len(self.peer_list) < MAX_PEER and peer.isHealthy() and peer not in self.peer_list:
-                peer.task = asyncio.create_task(peer.readMessage())
-                self.peer_list.append(peer)
+    def makeHandshake(self) -> bytes:
+        reserved = messages.DHT_RESERVED if self.dht else messages.HANDSHAKE_RESERVED
+        return messages.Handshake(self.peer_id, self.info_hash, reserved).writeMessage()
+
+    async def sendDHTPort(self, peer, handshake: messages.Handshake):
+        if self.dht and handshake.supportsDHT():
+            await peer.sendMessage(messages.Port(self.dht.port).writeMessage())
+
+    def createPeer(self, ip, port, peer_id='???'):
+        return Peer(self, ip, port, peer_id)
+
+    def attachPeer(self, peer) -> bool:
+        if len(self.peer_list) >= MAX_PEER or peer in self.peer_list:
+            return False
+        peer.task = asyncio.create_task(peer.readMessage())
+        self.peer_list.append(peer)
+        return True
 
     def removePeer(self, peer):
         if peer in self.peer_list:
-            peer.task.cancel()
             self.peer_list.remove(peer)
+        elif peer in self.inbound_peers:
+            self.inbound_peers.remove(peer)
+        else:
+            return
+        # a peer that hit EOF removes itself from inside its own task, which then just returns
+        if peer.task and peer.task is not asyncio.current_task():
+            peer.task.cancel()
+        if peer.writer:
+            peer.writer.close()
+        self.piece_manager.picker.removePeer(peer.have_pieces)
+        self.releaseRequests(peer)
+        for requested_from in self.inflight.values():
+            requested_from.discard(peer)
+        self.connections.onDisconnect(peer)
                 
     async def download(self):
+        # requests are refilled as soon as a peer unchokes us or delivers a block,
+        # this loop only expires stale requests and tops up peers that went idle
         while self.downloading:
-            peer = await self.downloadable_peers.get()
-            if not peer.isHealthy():
+            self.expireRequests()
+            for peer in list(self.peer_list):
+                await self.fillRequests(peer)
+            delay = self.piece_manager.request_timer.nextDeadline() - time.time()
+            await asyncio.sleep(min(max(delay, MIN_MAINTENANCE_INTERVAL), MAINTENANCE_INTERVAL))
+
+    def expireRequests(self):
+        for idx, begin, owner in self.piece_manager.expireRequests():
+            requested_from = self.inflight.get((idx, begin))
+            if requested_from:
+                requested_from.discard(owner)
+            if owner:
+                owner.expired_requests += 1
+                owner.outstanding.pop((idx, begin), None)
+                owner.shrinkQueue()
+
+    def releaseRequests(self, peer):
+        # hand the peer's outstanding blocks back to the picker unless another peer is fetching them too
+        for idx, begin in peer.outstanding:
+            requested_from = self.inflight.get((idx, begin))
+            if requested_from:
+                requested_from.discard(peer)
+            if not requested_from:
+                self.piece_manager.releaseBlock(idx, begin)
+        peer.outstanding.clear()
+
+    async def fillRequests(self, peer):
+        # keep queue_depth requests outstanding so the link never idles waiting for a round trip
+        if not self.downloading or peer.state['peer_choking'] or not peer.isHealthy():
+            return
+        requests = []
+        while len(peer.outstanding) < peer.queue_depth:
+            request_data = self.piece_manager.getEmptyBlockFor(peer.have_pieces, peer)
+            if not request_data:
+                break
+            requests.append(self.trackRequest(peer, *request_data))
+        if len(peer.outstanding) < peer.queue_depth and self.piece_manager.streaming and self.isFastPeer(peer):
+            requests.extend(self.pickDuplicates(peer, self.piece_manager.getUrgentBlocksFor(peer.have_pieces)))
+        if len(peer.outstanding) < peer.queue_depth and self.piece_manager.isEndgame():
+            requests.extend(self.pickDuplicates(peer, self.piece_manager.getPendingBlocksFor(peer.have_pieces)))
+        if requests:
+            try:
+                await peer.sendMessage(messages.Request.writeBatch(requests))
+            except (ConnectionError, OSError) as e:
+                # a dead connection only takes its own peer down, not the download loop or another peer's task
+                print(f'PEER_MAN: {peer.ip}:{peer.port} write failed: {e}')
+                self.removePeer(peer)
+
+    def trackRequest(self, peer, idx, begin, length):
+        self.inflight.setdefault((idx, begin), set()).add(peer)
+        peer.outstanding[(idx, begin)] = time.time()
+        return idx, begin, length
+
+    def isFastPeer(self, peer):
+        rates = sorted((other.download_rate.getRate() for other in self.peer_list if other.isHealthy()), reverse=True)
+        if len(rates) <= STREAM_FAST_PEERS:
+            return True
+        return peer.download_rate.getRate() >= rates[STREAM_FAST_PEERS - 1]
+
+    def pickDuplicates(self, peer, blocks):
+        # duplicate outstanding blocks to this peer too, the slower copies get cancelled on arrival
+        requests = []
+        for idx, begin, length in blocks:
+            if len(peer.outstanding) >= peer.queue_depth:
+                break
+            if (idx, begin) in peer.outstanding:
                 continue
-            if  len(peer.have_pieces) > 10:
-                have_pieces = random.sample(peer.have_pieces, 10)
-            else:
-                have_pieces = peer.have_pieces
-            for piece_idx in have_pieces:
-                if self.piece_manager.bitfield[piece_idx]:
-                    peer.have_pieces.remove(piece_idx)
-                    continue
-                request_data = self.piece_manager.getEmptyBlockFromPiece(piece_idx)
-                if request_data:
-                    req_idx, req_begin, req_length = request_data
-                    request = messages.Request(req_idx, req_begin, req_length)
-                    await peer.sendMessage(request.writeMessage())
-                    ## print(f'PEER_MAN: downloading piece {piece_idx} from {peer.ip}')
-                    await asyncio.sleep(0.01)
-            await asyncio.sleep(0.5)
-            await self.downloadable_peers.put(peer)
-
-    async def handleRequests(self):
-        while self.seeding:
-            peer, request = await self.requesting_peers.get()
-            if (peer, request) in self.cancelled_requests:
-                self.cancelled_requests.remove((peer, request))
+            requests.append(self.trackRequest(peer, idx, begin, length))
+        return requests
+
+    async def cancelDuplicates(self, peer, piece: messages.Piece):
+        requested_from = self.inflight.pop((piece.idx, piece.begin), set())
+        requested_from.discard(peer)
+        cancel = messages.Cancel(piece.idx, piece.begin, piece.block_length).writeMessage()
+        for other in requested_from:
+            other.outstanding.pop((piece.idx, piece.begin), None)
+            try:
+                await other.sendMessage(cancel)
+            except (ConnectionError, OSError) as e:
+                # runs in the read task of the peer that delivered, a dead target must not take that task down
+                print(f'PEER_MAN: {other.ip}:{other.port} write failed: {e}')
+                self.removePeer(other)
+
+    async def resumeDownload(self):
+        # wanted pieces came back after completion, peers holding any of them hear that we are interested again
+        bitfield = self.getBitfield()
+        picker = self.piece_manager.picker
+        for peer in self.connectedPeers():
+            if peer.state['am_interested'] or not any(picker.isWanted(idx) for idx in peer.have_pieces.andNot(bitfield)):
                 continue
-            block = self.piece_manager.getBlock(request.idx, request.begin, request.length)
-            if block:
-                piece = messages.Piece(request.idx, request.begin, block, request.length)
-                await peer.sendMessage(piece.writeMessage())
-                self.seeded += request.length
-                ## print(f'PEER_MAN: Request {peer.ip} for piece {request.idx} has been fulfilled!')
+            try:
+                await peer.sendInterested()
+            except (ConnectionError, OSError) as e:
+                print(f'PEER_MAN: {peer.ip}:{peer.port} write failed: {e}')
+                self.removePeer(peer)
 
-    async def addReadyPeer(self, peer):
-        await self.downloadable_peers.put(peer)
+    def connectedPeers(self):
+        return self.peer_list + self.inbound_peers
 
-    async def addRequestPeer(self, peer, request: messages.Request):
-        await self.requesting_peers.put((peer, request))
+    async def runChoker(self):
+        rounds = 0
+        while self.seeding:
+            try:
+                await self.rechoke(rounds % (OPTIMISTIC_INTERVAL // CHOKE_INTERVAL) == 0)
+            except (ConnectionError, OSError) as e:
+                print(f'PEER_MAN: rechoke failed: {e}')
+            rounds += 1
+            await asyncio.sleep(CHOKE_INTERVAL)
 
-    async def addPiece(self, piece: messages.Piece):
-        await self.piece_manager.receiveBlock(piece.idx, piece.begin, piece.block, piece.block_length)
+    async def rechoke(self, rotate_optimistic=False):
+        # tit-for-tat: unchoke the interested peers that give us the most, by download rate while
+        # leeching and upload rate while seeding, plus one optimistic slot so newcomers get a chance;
+        # whether a peer chokes us right now doesn't matter, its rate already says what it gives us
+        peers = self.connectedPeers()
+        interested = [peer for peer in peers if peer.state['peer_interested'] and peer.isConnected()]
+        if self.downloading:
+            rate = lambda peer: peer.download_rate.getRate()
+        else:
+            rate = lambda peer: peer.upload_rate.getRate()
+        unchoked = set(sorted(interested, key=rate, reverse=True)[:self.upload_slots])
+        if rotate_optimistic or self.optimistic not in interested or self.optimistic in unchoked:
+            candidates = [peer for peer in interested if peer not in unchoked]
+            self.optimistic = random.choice(candidates) if candidates else None
+        if self.optimistic:
+            unchoked.add(self.optimistic)
+        for peer in peers:
+            try:
+                await peer.setChoking(peer not in unchoked)
+            except (ConnectionError, OSError) as e:
+                print(f'PEER_MAN: {peer.ip}:{peer.port} write failed: {e}')
+                self.removePeer(peer)
+
+    async def onInterested(self, peer):
+        # a free slot is handed out right away instead of waiting for the next rechoke
+        unchoked = sum(1 for other in self.connectedPeers() if not other.state['am_choking'] and other is not self.optimistic)
+        if peer.state['am_choking'] and unchoked < self.upload_slots:
+            await peer.setChoking(False)
 
-    def removeRequest(self, peer, cancel: messages.Cancel):
-        request = messages.Request(cancel.idx, cancel.begin, cancel.length)
-        self.cancelled_requests.append((peer, request))
+    async def sendPiece(self, writer: asyncio.StreamWriter, request: messages.Request, sendfile=False, limiter: RateLimiter = None) -> bool:
+        # the header and the block go out as separate writes so the block is never copied into a message,
+        # with sendfile blocks that are only on disk skip user space entirely;
+        # the header promises request.length bytes, so a range past the piece end is refused before it is written
+        if not self.piece_manager.isValidRequest(request.idx, request.begin, request.length):
+            return False
+        on_disk = sendfile and self.piece_manager.isBlockOnDisk(request.idx)
+        block = None if on_disk else self.piece_manager.getBlock(request.idx, request.begin, request.length)
+        if not on_disk and not block:
+            return False
+        length = request.length if on_disk else len(block)
+        header = messages.Piece.writeHeader(request.idx, request.begin, length)
+        # a limited upload goes out in fragments so one peer can't drain a shared bucket in one go
+        limited = limiter is not None and limiter.limited
+        fragment = FRAGMENT_SIZE if limited else length
+        if limited:
+            await limiter.acquire(len(header))
+        writer.write(header)
+        for offset in range(0, length, fragment):
+            size = min(fragment, length - offset)
+            if limited:
+                await limiter.acquire(size)
+            if on_disk:
+                await self.piece_manager.storage.sendBlock(writer.transport, request.idx, request.begin + offset, size)
+            else:
+                writer.write(block[offset:offset+size])
+                await writer.drain()
+        return True
+
+    async def addPiece(self, peer, piece: messages.Piece):
+        await self.cancelDuplicates(peer, piece)
+        await self.piece_manager.receiveBlock(piece.idx, piece.begin, piece.block, piece.block_length)
 
     def getBitfield(self):
         return self.piece_manager.bitfield
 
     async def serveClientConnect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        peer_client = ':'.join(map(str, writer.get_extra_info('peername')))
-        print(f'SERVER: Accept connection from {peer_client}!')
+        # inbound connections run through the same Peer state machine as the ones we dial
+        ip, port = writer.get_extra_info('peername')[:2]
+        print(f'SERVER: Accept connection from {ip}:{port}!')
         try:
-            has_handshaked = False
-            while not has_handshaked:
-                resp = await reader.read(68)
-                print(f'SERVER: receives handshake! from {peer_client}')
-                read_handshake = messages.Handshake.readMessage(resp)
-                if read_handshake.info_hash != self.info_hash:
-                    print(f'SERVER: info_hash from {peer_client} did not match. aborting.')
-                    writer.close()
-                    return
-                has_handshaked = True
-        except:
-            print(f'SERVER: cannot read handshake from {peer_client}. aborting.')
+            read_handshake = messages.Handshake.readMessage(await asyncio.wait_for(reader.readexactly(68), 20))
+        except Exception:
+            print(f'SERVER: cannot read handshake from {ip}:{port}. aborting.')
             writer.close()
             return
-        # lets get to the point.
-        handshake = messages.Handshake(self.peer_id, self.info_hash)
-        writer.write(handshake.writeMessage())
-        await writer.drain()
-        raw_bitfield = self.getBitfield()
-        bitfield = messages.BitField(raw_bitfield)
-        writer.write(bitfield.writeMessage())
-        await writer.drain()
-        unchoke = messages.UnChoke()
-        writer.write(unchoke.writeMessage())
-        await writer.drain()
-        buffer = b''
-        while True:
-            try:
-                resp = await asyncio.wait_for(reader.read(BLOCK_SIZE), 20)
-                buffer += resp
-                print(f'SERVER: {peer_client} has read {len(resp)} buffer! now buffer {len(buffer)}')
-                if not buffer and not resp:
-                    break
-                while True:
-                    if len(buffer) < 4:
-                        break
-                    msg_len = struct.unpack('>I', buffer[:4])[0]
-                    total_length = msg_len + 4
-                    if len(buffer) < total_length:
-                        print(f'SERVER: {peer_client} length mismatch, reread. {len(buffer)} < {total_length}')
-                        break
-                    payload = buffer[:total_length]
-                    buffer = buffer[total_length:]
-                    if msg_len == 0:
-                        continue
-                    try:
-                        print(f'SERVER: {peer_client} Determining Message...')
-                        msg = messages.Message.determineMessage(payload)
-                        print(f'SERVER: {peer_client} successfully readed message {type(msg)}')
-                        if msg and isinstance(msg, messages.Request):
-                            block = self.piece_manager.getBlock(msg.idx, msg.begin, msg.length)
-                            if block:
-                                piece = messages.Piece(msg.idx, msg.begin, block, msg.length)
-                                writer.write(piece.writeMessage())
-                                await writer.drain()
-                                self.seeded += msg.length
-                                print(f'SERVER: Request {peer_client} for piece {msg.idx} has been fulfilled!')
-                                print(f'SERVER: seeded now {self.seeded}')
-                                await asyncio.sleep(0.2)
-                    except messages.WrongMessageException:
-                        print(f'SERVER: {peer_client} error determining message')
-                        continue
-            except Exception as e:
-                print(f'SERVER: {peer_client} receives error {type(e)}')
-                print(e)
-                print(f'SERVER: {peer_client} closing...')
-                writer.close()
-                return
-        writer.close()
-        return
+        if read_handshake.info_hash != self.info_hash:
+            print(f'SERVER: info_hash from {ip}:{port} did not match. aborting.')
+            writer.close()
+            return
+        peer = Peer(self, ip, port, read_handshake.peer_id)
+        peer.reader, peer.writer = reader, writer
+        peer.handshaked = True
+        peer.timeout = peer.connected_at = peer.time_span
+        peer.task = asyncio.current_task()
+        self.inbound_peers.append(peer)
+        try:
+            await peer.sendMessage(self.makeHandshake())
+            await peer.sendMessage(messages.BitField(self.getBitfield()).writeMessage())
+            await self.sendDHTPort(peer, read_handshake)
+            await peer.readMessage()
+        except (asyncio.CancelledError, ConnectionError, OSError):
+            pass
+        finally:
+            # the connection manager's pruning only runs while leeching, a seeding peer cleans up after itself
+            self.removePeer(peer)
 
 class Peer():
     def __init__(self, peer_manager: PeerManager, ip: str, port: int, peer_id='???'):
@@ -191,7 +324,36 @@ class Peer():
         self.handshaked = False
         self.timeout = 0
         self.retry = 0
-        self.have_pieces = []
+        self.have_pieces = Bitfield(len(peer_manager.getBitfield()))
+        self.expired_requests = 0
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        self.write_lock = asyncio.Lock()
+        self.connected_at = 0
+        # (idx, begin, length) -> Request, served in arrival order and cancelled by key
+        self.upload_queue: OrderedDict = OrderedDict()
+        self.upload_ready = asyncio.Event()
+        self.upload_task = None
+        self.upload_bucket = TokenBucket(peer_manager.peer_upload_limit)
+        self.download_bucket = TokenBucket(peer_manager.peer_download_limit)
+        self.upload_limiter = RateLimiter(GLOBAL_UPLOAD, peer_manager.upload_bucket, self.upload_bucket)
+        self.download_limiter = RateLimiter(GLOBAL_DOWNLOAD, peer_manager.download_bucket, self.download_bucket)
+        # (piece idx, begin) -> time the request was sent
+        self.outstanding = {}
+        self.queue_depth = MIN_QUEUE_DEPTH
+        self.min_rtt = INFINITE
+        self.msg_handler = {
+            messages.Choke: self.handleChoke,
+            messages.UnChoke: self.handleUnchoke,
+            messages.Interested: self.handleInterested,
+            messages.NotInterested: self.handleNotInterested,
+            messages.Have: self.handleHave,
+            messages.BitField: self.handleBitfield,
+            messages.Request: self.handleRequest,
+            messages.Piece: self.handlePiece,
+            messages.Cancel: self.handleCancel,
+            messages.Port: self.handlePort
+        }
         self.writer: asyncio.StreamWriter = None
         self.reader: asyncio.StreamReader = None
         self.task = None
@@ -199,6 +361,9 @@ class Peer():
     def __eq__(self, peer):
         return isinstance(peer, Peer) and self.ip == peer.ip and self.port == peer.port
 
+    def __hash__(self):
+        return hash((self.ip, self.port))
+
     def __repr__(self):
         return f'{self.peer_id} {self.ip}:{self.port}'
 
@@ -214,7 +379,19 @@ class Peer():
 
     def isHealthy(self) -> bool:
         return self.notTimeout() and self.isResponsive()
+
+    def isConnected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
     
+    def updateQueueDepth(self, rtt):
+        # bandwidth-delay product in blocks, using the round trip floor so queueing at the peer doesn't inflate it
+        self.min_rtt = min(self.min_rtt, rtt)
+        bdp = self.download_rate.getRate() * self.min_rtt / BLOCK_SIZE
+        self.queue_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, math.ceil(bdp) + QUEUE_MARGIN))
+
+    def shrinkQueue(self):
+        self.queue_depth = max(MIN_QUEUE_DEPTH, self.queue_depth // 2)
+
     def handleKeepAlive(self):
         self.timeout = self.time_span
 
@@ -222,10 +399,7 @@ class Peer():
         ## print(f'PEER: {self.ip}:{self.port} handling Interested...')
         self.timeout = self.time_span
         self.state['peer_interested'] = True
-        if self.state['am_choking']:
-            self.state['am_choking'] = False
-            unchoke = messages.UnChoke()
-            await self.sendMessage(unchoke.writeMessage())
+        await self.peer_manager.onInterested(self)
 
     async def handleNotInterested(self, _):
         ## print(f'PEER: {self.ip}:{self.port} handling Not Interested...')
@@ -236,55 +410,70 @@ class Peer():
         ## print(f'PEER: {self.ip}:{self.port} handling Choke...')
         self.state['peer_choking'] = True
         self.timeout = self.time_span + 10
+        # a choke discards every request we had queued at the peer
+        self.peer_manager.releaseRequests(self)
 
     async def handleUnchoke(self, _):
         ## print(f'PEER: {self.ip}:{self.port} handling Unchoke...')
         self.timeout = self.time_span
         self.state['peer_choking'] = False
-        await self.peer_manager.addReadyPeer(self)
+        await self.peer_manager.fillRequests(self)
     
     async def handleBitfield(self, bitfield: messages.BitField):
         ## print(f'PEER: {self.ip}:{self.port} handling Bitfield...')
         self.timeout = self.time_span
-        for idx, have in enumerate(bitfield.bitfield):
-            if have:
-                self.have_pieces.append(idx)
-        if self.peer_manager.downloading and self.state['peer_choking'] and not self.state['am_interested']:
-            interested = messages.Interested()
-            await self.sendMessage(interested.writeMessage())
-            self.state['am_interested'] = True
+        received = Bitfield.fromBytes(bitfield.bitfield.data, len(self.have_pieces))
+        new_pieces = received.andNot(self.have_pieces)
+        self.have_pieces.update(new_pieces)
+        self.peer_manager.piece_manager.picker.addPeer(new_pieces)
+        lacking = received.andNot(self.peer_manager.getBitfield())
+        if self.peer_manager.downloading and lacking.any() and self.state['peer_choking'] and not self.state['am_interested']:
+            await self.sendInterested()
             ## print(f'PEER: {self.ip}:{self.port} sent interested!')
 
     async def handleHave(self, have: messages.Have):
         ## print(f'PEER: {self.ip}:{self.port} handling Have...')
         self.timeout = self.time_span
-        self.have_pieces.append(have.piece_idx)
+        if have.piece_idx not in self.have_pieces and have.piece_idx < len(self.peer_manager.getBitfield()):
+            self.have_pieces.add(have.piece_idx)
+            self.peer_manager.piece_manager.picker.addHave(have.piece_idx)
         if self.peer_manager.downloading and self.state['peer_choking'] and not self.state['am_interested']:
-            interested = messages.Interested()
-            await self.sendMessage(interested.writeMessage())
-            self.state['am_interested'] = True
+            await self.sendInterested()
             ## print(f'PEER: {self.ip}:{self.port} sent interested!')
+        await self.peer_manager.fillRequests(self)
 
     async def handleRequest(self, request: messages.Request):
         ## print(f'PEER: {self.ip}:{self.port} handling Request...')
         self.timeout = self.time_span
-        if self.state['peer_interested'] and self.state['am_choking']:
-            await self.peer_manager.addRequestPeer(self, request)
+        if not self.peer_manager.piece_manager.isValidRequest(request.idx, request.begin, request.length):
+            print(f'PEER: {self.ip}:{self.port} sent an invalid request {request.idx}/{request.begin}/{request.length}, disconnecting')
+            self.peer_manager.removePeer(self)
+            return
+        if self.state['peer_interested'] and not self.state['am_choking'] and len(self.upload_queue) < MAX_UPLOAD_QUEUE:
+            self.upload_queue[(request.idx, request.begin, request.length)] = request
+            self.upload_ready.set()
     
     async def handlePiece(self, piece: messages.Piece):
         ## print(f'PEER: {self.ip}:{self.port} handling Piece...')
         self.timeout = self.time_span
-        await self.peer_manager.addPiece(piece)
+        requested_at = self.outstanding.pop((piece.idx, piece.begin), None)
+        self.download_rate.add(piece.block_length)
+        self.peer_manager.downloaded += piece.block_length
+        if requested_at is not None:
+            self.updateQueueDepth(self.time_span - requested_at)
+        await self.peer_manager.addPiece(self, piece)
+        await self.peer_manager.fillRequests(self)
 
     async def handleCancel(self, cancel: messages.Cancel):
         ## print(f'PEER: {self.ip}:{self.port} handling Cancel...')
         self.timeout = self.time_span
-        self.peer_manager.removeRequest(self, cancel)
+        self.upload_queue.pop((cancel.idx, cancel.begin, cancel.length), None)
 
     async def handlePort(self, port: messages.Port):
         ## print(f'PEER: {self.ip}:{self.port} handling Port...')
         self.timeout = self.time_span
-        pass
+        if self.peer_manager.dht and port.port:
+            self.peer_manager.dht.addNode(PeerAddress(self.ip, port.port))
 
     async def connect(self):
         try:
@@ -293,10 +482,10 @@ class Peer():
                 asyncio.open_connection(self.ip, self.port),
                 timeout=5
             )
-            handshake = messages.Handshake(self.peer_manager.peer_id.encode(), self.peer_manager.info_hash)
-            self.writer.write(handshake.writeMessage())
+            self.writer.write(self.peer_manager.makeHandshake())
             await self.writer.drain()
             self.timeout = self.time_span
+            self.connected_at = self.time_span
             ## print(f'PEER: Connected and handshake sent to {self.ip}:{self.port}!')
         except Exception as e:
             print(f'PEER: {self.ip}:{self.port} Cannot create connection')
@@ -306,62 +495,107 @@ class Peer():
         finally:
             return self
     
-    async def readHandshake(self):
-        resp = await self.reader.read(68)
+    async def readHandshake(self) -> bool:
         try:
+            resp = await self.reader.readexactly(68)
             handshake_msg = messages.Handshake.readMessage(resp)
+            if handshake_msg.info_hash != self.peer_manager.info_hash:
+                print(f'PEER: info_hash from {self.ip}:{self.port} did not match!')
+                return False
             self.handshaked = True
             self.timeout = self.time_span
             # print(f'PEER: handshake readed from {self.ip}:{self.port}!')
-        except:
+            if self.peer_manager.getBitfield().any():
+                await self.sendMessage(messages.BitField(self.peer_manager.getBitfield()).writeMessage())
+            await self.peer_manager.sendDHTPort(self, handshake_msg)
+            return True
+        except (asyncio.IncompleteReadError, messages.WrongMessageException, struct.error, ConnectionError, OSError):
             print(f'PEER: {self.ip} does not receive handshake msg first!')
             self.timeout = INFINITE
-            self.task.cancel()
+            return False
 
     async def sendMessage(self, message: bytes):
-        if self.isHealthy():
+        # health only decides whether we ask a peer for blocks, anything we owe it on the wire always goes out
+        async with self.write_lock:
+            await self.upload_limiter.acquire(len(message))
             self.writer.write(message)
             await self.writer.drain()
-            self.timeout = self.time_span
+
+    async def sendInterested(self):
+        await self.sendMessage(messages.Interested().writeMessage())
+        self.state['am_interested'] = True
+
+    async def sendPiece(self, request: messages.Request) -> bool:
+        # writes are serialized per connection, so sendfile never races our own requests or choke messages;
+        # a choke that got in first discards the request
+        async with self.write_lock:
+            if self.state['am_choking']:
+                return False
+            sent = await self.peer_manager.sendPiece(self.writer, request, self.peer_manager.use_sendfile, self.upload_limiter)
+        if sent:
+            self.upload_rate.add(request.length)
+        return sent
+
+    async def setChoking(self, choking: bool):
+        if self.state['am_choking'] == choking:
+            return
+        message = messages.Choke() if choking else messages.UnChoke()
+        await self.sendMessage(message.writeMessage())
+        # the state only follows once the peer has been told, so both sides agree on it
+        self.state['am_choking'] = choking
+        if choking:
+            # choking discards everything the peer has asked for so far
+            self.upload_queue.clear()
+
+    async def uploadLoop(self):
+        # queued requests go out back to back, drain() only waits once the socket buffer is full
+        while True:
+            if not self.upload_queue:
+                self.upload_ready.clear()
+                await self.upload_ready.wait()
+                continue
+            _, request = self.upload_queue.popitem(last=False)
+            try:
+                sent = await self.sendPiece(request)
+            except (ConnectionError, RuntimeError) as e:
+                print(f'PEER: {self.ip}:{self.port} upload failed: {e}')
+                return
+            if sent:
+                self.peer_manager.seeded += request.length
 
     async def readMessage(self):
+        try:
+            await self.readMessages()
+        finally:
+            if self.upload_task:
+                self.upload_task.cancel()
+
+    async def readMessages(self):
         while True:
             if not self.handshaked:
-                await self.readHandshake()
+                # a peer that hangs up or answers for another torrent is dropped, not read again
+                if not await self.readHandshake():
+                    self.peer_manager.removePeer(self)
+                    return
             else:
                 # print(f'PEER: {self.ip}:{self.port} starts reading messages')
-                msg_handler = {
-                    messages.Choke: self.handleChoke,
-                    messages.UnChoke: self.handleUnchoke,
-                    messages.Interested: self.handleInterested,
-                    messages.NotInterested: self.handleNotInterested,
-                    messages.Have: self.handleHave,
-                    messages.BitField: self.handleBitfield,
-                    messages.Request: self.handleRequest,
-                    messages.Piece: self.handlePiece,
-                    messages.Cancel: self.handleCancel,
-                    messages.Port: self.handlePort
-                }
-                buffer = b''
+                self.upload_task = asyncio.create_task(self.uploadLoop())
+                framer = messages.MessageFramer()
                 while True:
-                    resp = await self.reader.read(BLOCK_SIZE)
-                    buffer += resp
-                    # print(f'PEER: {self.ip}:{self.port} has read {len(resp)} buffer! now buffer {len(buffer)}')
-                    if not buffer and not resp:
-                        self.task.cancel()
+                    try:
+                        resp = await self.reader.read(BLOCK_SIZE)
+                    except (ConnectionError, OSError):
+                        resp = b''
+                    # print(f'PEER: {self.ip}:{self.port} has read {len(resp)} buffer! now buffer {len(framer)}')
+                    if not resp:
+                        self.peer_manager.removePeer(self)
                         return
+                    # paying for a read after the fact delays the next one, which lets TCP push back on the sender
+                    await self.download_limiter.acquire(len(resp))
+                    framer.feed(resp)
                     self.timeout = self.time_span
-                    while True:
-                        if len(buffer) < 4:
-                            break
-                        msg_len = struct.unpack('>I', buffer[:4])[0]
-                        total_length = msg_len + 4
-                        if len(buffer) < total_length:
-                            # print(f'PEER: {self.ip}:{self.port} length mismatch, reread. {len(buffer)} < {total_length}')
-                            break
-                        payload = buffer[:total_length]
-                        buffer = buffer[total_length:]
-                        if msg_len == 0:
+                    for payload in framer.messages():
+                        if len(payload) == 4:
                             self.handleKeepAlive()
                             continue
                         try:
@@ -369,9 +603,15 @@ class Peer():
                             msg = messages.Message.determineMessage(payload)
                             # print(f'PEER: {self.ip}:{self.port} successfully readed message {type(msg)}')
                             if msg:
-                                await msg_handler[type(msg)](msg)
+                                await self.msg_handler[type(msg)](msg)
+                            if not self.isConnected():
+                                # a handler dropped this peer, whatever is left in the buffer goes with it
+                                return
                         except messages.WrongMessageException:
                             print(f'PEER: {self.ip} error determining message')
                             continue
-
-
+                        except (ConnectionError, OSError) as e:
+                            # a handler writing back to this peer found the connection gone
+                            print(f'PEER: {self.ip}:{self.port} write failed: {e}')
+                            self.peer_manager.removePeer(self)
+                            return
@@ -0,0 +1,185 @@
+import random
+from typing import Iterable, Iterator, List, Optional, Set
+
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 4
+PRIORITY_HIGH = 7
+
+class PiecePicker():
+    def __init__(self, num_pieces: int):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+        # buckets[n] lists the missing pieces that exactly n connected peers have,
+        # position maps a piece to its slot so moving between buckets is a swap-remove
+        self.buckets: List[List[int]] = [list(range(num_pieces))]
+        self.position = list(range(num_pieces))
+        self.missing = set(range(num_pieces))
+        self.partial: Set[int] = set()
+        self.lowest = 0
+        # streaming window [window_start, window_end), empty unless streaming
+        self.window_start = 0
+        self.window_end = 0
+        self.priority = [PRIORITY_NORMAL] * num_pieces
+        self.priority_counts = {PRIORITY_NORMAL: num_pieces}
+        self.wanted_missing = num_pieces
+
+    def bucketRemove(self, piece_idx: int, count: int):
+        bucket = self.buckets[count]
+        last = bucket.pop()
+        if last != piece_idx:
+            slot = self.position[piece_idx]
+            bucket[slot] = last
+            self.position[last] = slot
+
+    def bucketAdd(self, piece_idx: int, count: int):
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        self.position[piece_idx] = len(self.buckets[count])
+        self.buckets[count].append(piece_idx)
+
+    def moveBucket(self, piece_idx: int, old: int, new: int):
+        if piece_idx not in self.missing:
+            return
+        self.bucketRemove(piece_idx, old)
+        self.bucketAdd(piece_idx, new)
+        if new < self.lowest:
+            self.lowest = new
+
+    def addHave(self, piece_idx: int):
+        count = self.availability[piece_idx]
+        self.availability[piece_idx] = count + 1
+        self.moveBucket(piece_idx, count, count + 1)
+
+    def removeHave(self, piece_idx: int):
+        count = self.availability[piece_idx]
+        if count == 0:
+            return
+        self.availability[piece_idx] = count - 1
+        self.moveBucket(piece_idx, count, count - 1)
+
+    def addPeer(self, pieces: Iterable[int]):
+        for piece_idx in pieces:
+            self.addHave(piece_idx)
+
+    def removePeer(self, pieces: Iterable[int]):
+        for piece_idx in pieces:
+            self.removeHave(piece_idx)
+
+    def markPartial(self, piece_idx: int):
+        if piece_idx in self.missing:
+            self.partial.add(piece_idx)
+
+    def markComplete(self, piece_idx: int):
+        if piece_idx not in self.missing:
+            return
+        self.missing.discard(piece_idx)
+        self.partial.discard(piece_idx)
+        self.bucketRemove(piece_idx, self.availability[piece_idx])
+        if self.priority[piece_idx] != PRIORITY_SKIP:
+            self.wanted_missing -= 1
+
+    def setPriority(self, piece_idx: int, priority: int):
+        old = self.priority[piece_idx]
+        self.priority[piece_idx] = priority
+        self.priority_counts[old] -= 1
+        self.priority_counts[priority] = self.priority_counts.get(priority, 0) + 1
+        if piece_idx in self.missing and (old == PRIORITY_SKIP) != (priority == PRIORITY_SKIP):
+            self.wanted_missing += 1 if old == PRIORITY_SKIP else -1
+
+    def isWanted(self, piece_idx: int) -> bool:
+        return self.priority[piece_idx] != PRIORITY_SKIP
+
+    def wantedPieces(self) -> Iterator[int]:
+        for piece_idx in self.missing:
+            if self.priority[piece_idx] != PRIORITY_SKIP:
+                yield piece_idx
+
+    def setWindow(self, start: int, end: int):
+        self.window_start = max(0, start)
+        self.window_end = min(self.num_pieces, end)
+
+    def inWindow(self, piece_idx: int) -> bool:
+        return self.window_start <= piece_idx < self.window_end
+
+    def windowPieces(self, peer_pieces: Set[int]) -> Iterator[int]:
+        for piece_idx in range(self.window_start, self.window_end):
+            if piece_idx in self.missing and piece_idx in peer_pieces and self.priority[piece_idx] != PRIORITY_SKIP:
+                yield piece_idx
+
+    def candidates(self, peer_pieces: Set[int]) -> Iterator[int]:
+        # streaming window in playback order first, then partially downloaded pieces,
+        # then missing pieces from rarest to most common, one pass per priority level
+        yield from self.windowPieces(peer_pieces)
+        for piece_idx in self.partial:
+            if piece_idx in peer_pieces and not self.inWindow(piece_idx) and self.priority[piece_idx] != PRIORITY_SKIP:
+                yield piece_idx
+        while self.lowest < len(self.buckets) and not self.buckets[self.lowest]:
+            self.lowest += 1
+        levels = sorted((level for level, count in self.priority_counts.items() if count and level != PRIORITY_SKIP), reverse=True)
+        for level in levels:
+            for count in range(max(self.lowest, 1), len(self.buckets)):
+                bucket = self.buckets[count]
+                if not bucket:
+                    continue
+                # random start inside the bucket so peers don't all chase the same rare piece
+                size = len(bucket)
+                start = random.randrange(size)
+                for offset in range(size):
+                    piece_idx = bucket[(start + offset) % size]
+                    if (piece_idx in peer_pieces and piece_idx not in self.partial and not self.inWindow(piece_idx)
+                            and self.priority[piece_idx] == level):
+                        yield piece_idx
+
+    def pick(self, peer_pieces: Set[int]) -> Optional[int]:
+        return next(self.candidates(peer_pieces), None)
+
+class RandomPicker(PiecePicker):
+    def candidates(self, peer_pieces: Set[int]) -> Iterator[int]:
+        pieces = [piece_idx for piece_idx in self.missing if piece_idx in peer_pieces]
+        random.shuffle(pieces)
+        return iter(pieces)
+
+def simulate(picker_cls, num_peers: int = 40, num_pieces: int = 400, neighbours: int = 6, seed_slots: int = 2, seed: int = 0) -> int:
+    # upload bound swarm: every peer uploads one piece per round and the seed uploads seed_slots pieces,
+    # leechers download from every source that still has a free slot and a piece they lack
+    rng = random.Random(seed)
+    random.seed(seed)
+    haves = [set() for _ in range(num_peers)]
+    pickers = [picker_cls(num_pieces) for _ in range(num_peers)]
+    links = [rng.sample([other for other in range(num_peers) if other != peer], neighbours) for peer in range(num_peers)]
+    watchers = [[other for other in range(num_peers) if peer in links[other]] for peer in range(num_peers)]
+    seed_pieces = set(range(num_pieces))
+    for picker in pickers:
+        picker.addPeer(seed_pieces)
+    rounds = 0
+    while any(len(have) < num_pieces for have in haves):
+        rounds += 1
+        slots = [1] * num_peers + [seed_slots]
+        received = []
+        for peer in rng.sample(range(num_peers), num_peers):
+            requested = set()
+            sources = links[peer] + [num_peers]
+            for other in rng.sample(sources, len(sources)):
+                if not slots[other]:
+                    continue
+                candidates = pickers[peer].candidates(seed_pieces if other == num_peers else haves[other])
+                piece_idx = next((idx for idx in candidates if idx not in requested), None)
+                if piece_idx is not None:
+                    slots[other] -= 1
+                    requested.add(piece_idx)
+                    received.append((peer, piece_idx))
+        for peer, piece_idx in received:
+            haves[peer].add(piece_idx)
+            pickers[peer].markComplete(piece_idx)
+            for other in watchers[peer]:
+                pickers[other].addHave(piece_idx)
+    return rounds
+
+if __name__ == "__main__":
+    import time
+    for picker_cls in (RandomPicker, PiecePicker):
+        start = time.perf_counter()
+        results = [simulate(picker_cls, seed=seed) for seed in range(5)]
+        elapsed = time.perf_counter() - start
+        print(f'PICKER: {picker_cls.__name__:12} swarm completion rounds {results} avg {sum(results) / len(results):.1f} ({elapsed:.2f}s)')
@@ -1,65 +1,103 @@
 import os
 import math
-from collections import defaultdict
-import time
 import hashlib
-import bitstring
-import asyncio
+import time
+from bitfield import Bitfield
 from torrent import Torrent
-from block import Block, BLOCK_SIZE, State
+from storage import Storage, FileSpanIndex
+from resume import ResumeData
+from verify import HashVerifier
+from diskio import DiskWriter, DISK_WORKERS
+from picker import PiecePicker, PRIORITY_SKIP, PRIORITY_NORMAL
+from timer import RequestTimer
+from block import Block, BufferPool, BLOCK_SIZE, State
+
+INLINE_HASH_BLOCKS = 4
+REQUEST_TIMEOUT = 5
+STREAM_WINDOW = 20
+STREAM_PIECE_INTERVAL = 1.0
+# largest block a peer may ask for, mainline clients drop anything over 16 KiB and libtorrent over 128 KiB
+MAX_REQUEST_SIZE = 2**17
+# pieces kept for reuse per disk worker, enough to cover the writes in flight
+POOLED_PIECES_PER_WORKER = 4
 
 class PieceManager():
-    def __init__(self, torrent : Torrent):
+    def __init__(self, torrent : Torrent, file_priorities=None):
         self.torrent = torrent
-        self.bitfield = bitstring.BitArray(torrent.getNumPieces())
+        self.bitfield = Bitfield(torrent.getNumPieces())
         self.initialize_pieces()
         self.initialize_files()
+        self.storage = Storage(torrent, self.spans)
+        self.file_priorities = {file_info['path']: PRIORITY_NORMAL for file_info in torrent.raw_files}
+        for file_idx, priority in enumerate(file_priorities or []):
+            self.applyFilePriority(torrent.raw_files[file_idx]['path'], priority)
+        self.verifier = HashVerifier()
         self.completed_pieces = 0
         self.completed_size = 0
-        self.writable_piece = asyncio.Queue()
-        if self.isAlreadyDone():
+        self.disk = DiskWriter(self.storage)
+        self.request_timer = RequestTimer(REQUEST_TIMEOUT)
+        self.streaming = False
+        self.stream_window = STREAM_WINDOW
+        self.stream_bitrate = None
+        self.stream_cursor = 0
+        self.cursor_time = 0
+        # called when the download has to start again, e.g. a skipped file is wanted after completion
+        self.on_reopen = None
+        self.resume = ResumeData(torrent.getResumePath(), torrent.getInfoHash(), torrent.getPieceSize(), torrent.getNumPieces())
+        if self.resume.load():
+            self.extractResume()
+        elif self.isAlreadyDone():
             self.extractDone()
+        self.storage.preallocate()
+        self.saveResume()
     
     def initialize_pieces(self):
         num_of_pieces = self.torrent.getNumPieces()
-        self.pieces = [Piece(idx, self.torrent.getHashPiece(idx), self.torrent.getPieceSize()) for idx in range(num_of_pieces-1)]
+        self.buffer_pool = BufferPool(POOLED_PIECES_PER_WORKER * DISK_WORKERS * self.torrent.getPieceSize())
+        self.picker = PiecePicker(num_of_pieces)
+        self.pieces = [Piece(idx, self.torrent.getHashPiece(idx), self.torrent.getPieceSize(), self.buffer_pool) for idx in range(num_of_pieces-1)]
         total_size = self.torrent.getSize()
         last_piece_size = total_size % self.torrent.getPieceSize() if total_size % self.torrent.getPieceSize() != 0 else self.torrent.getPieceSize()
-        self.pieces.append(Piece(num_of_pieces-1, self.torrent.getHashPiece(num_of_pieces-1), last_piece_size))
+        self.pieces.append(Piece(num_of_pieces-1, self.torrent.getHashPiece(num_of_pieces-1), last_piece_size, self.buffer_pool))
 
     def initialize_files(self):
-        self.files = defaultdict(list)
-        piece_offset = 0
-        piece_size_used = 0
-        for current_file in self.torrent.raw_files:
-            current_file_size = current_file['length']
-            file_offset = 0
-            while current_file_size > 0:
-                piece_idx = int(piece_offset / self.torrent.getPieceSize())
-                piece_size = self.pieces[piece_idx].piece_size - piece_size_used
-                if current_file_size - piece_size < 0:
-                    file_info = {
-                        'path': current_file['path'],
-                        'length': current_file_size,
-                        'piece_offset': piece_size_used,
-                        'file_offset': file_offset
-                    }
-                    piece_offset += current_file_size
-                    file_offset += current_file_size
-                    piece_size_used += current_file_size
-                    current_file_size = 0
-                else:
-                    current_file_size -= piece_size
-                    file_info = {
-                        'path': current_file['path'],
-                        'length': piece_size,
-                        'piece_offset': piece_size_used,
-                        'file_offset': file_offset
-                    }
-                    piece_offset += piece_size
-                    file_offset += piece_size
-                    piece_size_used = 0
-                self.files[piece_idx].append(file_info)
+        self.spans = FileSpanIndex(self.torrent.raw_files, self.torrent.getPieceSize())
+
+    def applyFilePriority(self, path, priority):
+        self.file_priorities[path] = priority
+        self.storage.setSkipped(path, priority == PRIORITY_SKIP)
+        for piece_idx in self.spans.pieceRange(path):
+            # a piece shared by several files is as important as its most important file
+            piece_priority = max(self.file_priorities[piece_path] for piece_path in self.spans.pathsForPiece(piece_idx))
+            self.picker.setPriority(piece_idx, piece_priority)
+
+    def setFilePriority(self, file_idx, priority):
+        path = self.torrent.raw_files[file_idx]['path']
+        skipping = priority == PRIORITY_SKIP
+        was_skipped = self.file_priorities[path] == PRIORITY_SKIP
+        was_complete = self.isComplete()
+        moved = {}
+        if was_skipped != skipping:
+            # completed pieces are read from where the file's bytes live now and written back once the priority
+            # is applied, so skipping moves them into the partfile and unskipping moves them back into the file;
+            # pieces still waiting for the disk writer land in the right place when they are written
+            for piece_idx in self.spans.pieceRange(path):
+                if self.isBlockOnDisk(piece_idx):
+                    moved[piece_idx] = self.storage.readPiece(piece_idx, self.pieces[piece_idx].piece_size)
+        self.applyFilePriority(path, priority)
+        if moved and not skipping:
+            self.storage.preallocate({path})
+        for piece_idx, data in moved.items():
+            self.storage.writePiece(piece_idx, data)
+        if was_complete and not self.isComplete():
+            self.reopen()
+
+    def reopen(self):
+        # wanted pieces came back after the download finished, the disk writer and the download start again
+        print(f'PIECE_MAN: {self.picker.wanted_missing} wanted pieces missing again, reopening download')
+        self.disk.reopen()
+        if self.on_reopen:
+            self.on_reopen()
 
     def isAlreadyDone(self):
         for file_info in self.torrent.raw_files:
@@ -69,146 +107,315 @@ class PieceManager():
                 return False
         return True
 
+    def markDone(self, piece):
+        self.completed_pieces += 1
+        self.completed_size += piece.piece_size
+        self.bitfield[piece.piece_index] = True
+        self.resume.bitfield[piece.piece_index] = True
+        self.picker.markComplete(piece.piece_index)
+
     def extractDone(self):
-        for piece_idx, infos in self.files.items():
-            buffer = b''
-            for file_info in infos:
-                try:
-                    f = open(file_info['path'], 'rb')
-                except Exception:
-                    print(f'PIECE_MAN: error extracting from done works')
-                    break
-                f.seek(file_info['file_offset'])
-                buffer += f.read(file_info['length'])
-                f.close()
-            self.pieces[piece_idx].setPiece(buffer)
-            self.completed_pieces += 1
-            self.bitfield[piece_idx] = True
-            self.completed_size += len(buffer)
-            buffer = b''
+        for piece, ok in self.verifier.recheck(self.pieces, self.storage.readPiece):
+            if ok:
+                piece.setComplete()
+                self.markDone(piece)
         print('PIECE_MAN: Extracting done! ')
 
+    def extractResume(self):
+        changed = self.resume.changedFiles(self.torrent.raw_files)
+        # skipped files are read back from the partfile, so they never block a rehash
+        intact = {file_info['path'] for file_info in self.torrent.raw_files if file_info['path'] in self.storage.skipped
+            or (os.path.exists(file_info['path']) and os.path.getsize(file_info['path']) == file_info['length'])}
+        rehash = []
+        for piece in self.pieces:
+            if not self.resume.bitfield[piece.piece_index]:
+                # a piece we never recorded is downloaded again, a newer mtime on its file proves nothing about it
+                continue
+            paths = self.spans.pathsForPiece(piece.piece_index)
+            if paths & changed:
+                self.resume.bitfield[piece.piece_index] = False
+                if paths <= intact:
+                    rehash.append(piece)
+            else:
+                piece.setComplete()
+                self.markDone(piece)
+        for piece, ok in self.verifier.recheck(rehash, self.storage.readPiece):
+            if ok:
+                piece.setComplete()
+                self.markDone(piece)
+        print(f'PIECE_MAN: Resumed {self.completed_pieces} pieces, rehashed {len(rehash)} pieces from {len(changed)} changed files')
+
+    def close(self):
+        # pieces written since the last periodic save would otherwise cost a rehash of their files on restart
+        self.saveResume()
+
+    def saveResume(self):
+        try:
+            self.resume.save(self.torrent.raw_files)
+        except OSError:
+            print(f'PIECE_MAN: error saving resume data to {self.resume.path}')
+
     def getPiece(self, piece_idx):
         return self.pieces[piece_idx]
 
-    def getEmptyBlockFromPiece(self, piece_idx):
-        self.pieces[piece_idx].updateBlockStatus()
-        return self.getPiece(piece_idx).getEmptyBlock()
+    def getEmptyBlockFromPiece(self, piece_idx, peer=None):
+        piece = self.getPiece(piece_idx)
+        request_data = piece.getEmptyBlock()
+        if request_data:
+            _, begin, _ = request_data
+            self.request_timer.add((piece_idx, begin), peer, piece.blocks[begin // BLOCK_SIZE].last_seen)
+        return request_data
+
+    def expireRequests(self, now=None):
+        # frees blocks whose request outlived REQUEST_TIMEOUT and returns (idx, begin, peer) for each
+        expired = []
+        for (piece_idx, begin), peer, requested_at in self.request_timer.expire(now or time.time()):
+            if self.pieces[piece_idx].expireBlock(begin, requested_at):
+                expired.append((piece_idx, begin, peer))
+        return expired
+
+    def releaseBlock(self, piece_idx, begin):
+        return self.pieces[piece_idx].expireBlock(begin)
+
+    def isEndgame(self):
+        # every block that is still missing has already been requested from some peer
+        if not self.picker.wanted_missing:
+            return False
+        for piece_idx in self.picker.wantedPieces():
+            if self.pieces[piece_idx].hasFreeBlock():
+                return False
+        return True
+
+    def getPendingBlocksFor(self, peer_pieces):
+        pending = []
+        for piece_idx in self.picker.wantedPieces():
+            if piece_idx in peer_pieces:
+                pending.extend(self.pieces[piece_idx].getPendingBlocks())
+        return pending
+
+    def setStreaming(self, enabled=True, window=STREAM_WINDOW, bitrate=None):
+        # bitrate in bytes per second spaces the piece deadlines, without it pieces are STREAM_PIECE_INTERVAL apart
+        self.streaming = enabled
+        self.stream_window = window
+        self.stream_bitrate = bitrate
+        if enabled:
+            self.setCursor(self.stream_cursor)
+        else:
+            self.picker.setWindow(0, 0)
+
+    def setCursor(self, piece_idx):
+        self.stream_cursor = min(max(piece_idx, 0), len(self.pieces) - 1)
+        self.cursor_time = time.time()
+        if self.streaming:
+            self.picker.setWindow(self.stream_cursor, self.stream_cursor + self.stream_window)
+
+    def seek(self, byte_offset):
+        self.setCursor(byte_offset // self.torrent.getPieceSize())
+
+    def getDeadline(self, piece_idx):
+        interval = self.torrent.getPieceSize() / self.stream_bitrate if self.stream_bitrate else STREAM_PIECE_INTERVAL
+        return self.cursor_time + (piece_idx - self.stream_cursor + 1) * interval
+
+    def getUrgentBlocksFor(self, peer_pieces, now=None):
+        # pending blocks of window pieces that would miss their deadline if the current request timed out
+        now = now or time.time()
+        urgent = []
+        for piece_idx in self.picker.windowPieces(peer_pieces):
+            if self.getDeadline(piece_idx) <= now + REQUEST_TIMEOUT:
+                urgent.extend(self.pieces[piece_idx].getPendingBlocks())
+        return urgent
+
+    def getEmptyBlockFor(self, peer_pieces, peer=None):
+        for piece_idx in self.picker.candidates(peer_pieces):
+            request_data = self.getEmptyBlockFromPiece(piece_idx, peer)
+            if request_data:
+                self.picker.markPartial(piece_idx)
+                return request_data
+        return None
     
     def getBlock(self, idx, begin, block_length):
-        if not self.getPiece(idx).complete:
+        piece = self.getPiece(idx)
+        if not piece.complete:
             return None
-        return self.getPiece(idx).getBlock(begin, block_length)
+        if piece.buffer is not None:
+            return piece.getBlock(begin, block_length)
+        return self.storage.readBlock(idx, begin, block_length)
+
+    def isValidRequest(self, idx, begin, length):
+        # the range has to lie inside one piece of this torrent
+        if not 0 <= idx < len(self.pieces) or not 0 < length <= MAX_REQUEST_SIZE:
+            return False
+        return 0 <= begin and begin + length <= self.pieces[idx].piece_size
+
+    def isBlockOnDisk(self, idx):
+        piece = self.getPiece(idx)
+        return piece.complete and piece.buffer is None
 
     async def receiveBlock(self, idx, begin, block, block_length):
-        if self.pieces[idx].complete:
+        piece = self.pieces[idx]
+        if piece.complete or piece.verifying:
             return
-        res = self.pieces[idx].setBlock(begin, block, block_length)
+        res = piece.setBlock(begin, block, block_length)
         if res:
             self.completed_size += block_length
             # print(f'PIECE_MAN: received piece_idx {idx}! completed size now {self.completed_size}')
-        if self.pieces[idx].isComplete():
+        if piece.hasAllBlocks():
+            piece.verifying = True
+            data = piece.buffer
+            if piece.unhashedBlocks() > INLINE_HASH_BLOCKS:
+                valid = await self.verifier.verifyTail(piece)
+            else:
+                valid = piece.finishHash() == piece.piece_hash
+            piece.verifying = False
+            if not valid:
+                # print(f'PIECE_MAN: piece {idx} has different piece_hash')
+                self.completed_size -= piece.piece_size
+                piece.flush()
+                return
+            piece.setComplete()
             self.completed_pieces += 1
             self.bitfield[idx] = True
-            await self.writable_piece.put(self.pieces[idx])
+            self.picker.markComplete(idx)
             print(f'PIECE_MAN: piece {idx} completed!')
+            # waits here while the disk writer is backlogged, which stops reading from this peer
+            await self.disk.put(idx, data)
             if self.isComplete():
-                await self.writable_piece.put(None)
+                self.disk.close()
     
     def isComplete(self):
-        return self.completed_pieces == self.torrent.getNumPieces()
+        return self.picker.wanted_missing == 0
 
     async def writePiece(self):
-        while True:
-            piece = await self.writable_piece.get()
-            if not piece:
-                break
-            for file_info in self.files[piece.piece_index]:
-                try:
-                    f = open(file_info['path'], 'r+b')
-                except IOError:
-                    f = open(file_info['path'], 'wb')
-                except Exception:
-                    print(f'PIECE_MAN: error writing file for piece_idx {piece.piece_index}')
-                    break
-                f.seek(file_info['file_offset'])
-                f.write(piece.data[file_info['piece_offset'] : file_info['piece_offset']+file_info['length']])
-                f.close()
-                print(f'PIECE_MAN: successfully write piece {piece.piece_index} to file {file_info["path"]}')
-            await asyncio.sleep(0.01)
+        await self.disk.run(self.onPieceWritten)
+        # every buffer is back from the disk writer, a finished download has no use for them
+        if self.isComplete():
+            self.buffer_pool.clear()
+        self.saveResume()
+
+    def onPieceWritten(self, piece_idx, success):
+        if not success:
+            print(f'PIECE_MAN: error writing file for piece_idx {piece_idx}')
+            return
+        self.pieces[piece_idx].release()
+        self.resume.bitfield[piece_idx] = True
+        if self.resume.isDue():
+            self.saveResume()
+        print(f'PIECE_MAN: successfully write piece {piece_idx} to disk')
 
 class Piece():
-    def __init__(self, piece_index: int, piece_hash: bytes, piece_size: int):
+    def __init__(self, piece_index: int, piece_hash: bytes, piece_size: int, buffer_pool: BufferPool):
         self.piece_index = piece_index
         self.piece_hash = piece_hash
         self.piece_size = piece_size
         self.num_blocks = int(math.ceil(float(piece_size) / BLOCK_SIZE))
         self.initialize_blocks()
         self.complete = False
-        self.data = b''
+        self.verifying = False
+        self.buffer_pool = buffer_pool
+        self.buffer: bytearray = None
+        self.hasher = None
+        self.hashed_blocks = 0
 
     def initialize_blocks(self):
         self.blocks = [Block() for x in range(self.num_blocks-1)]
         last_block_size = self.piece_size % BLOCK_SIZE if self.piece_size % BLOCK_SIZE != 0 else BLOCK_SIZE
         self.blocks.append(Block(last_block_size))
+        self.free_blocks = self.num_blocks
+        self.free_hint = 0
 
     def flush(self):
-        self.data = b''
         for block in self.blocks:
             block.flush()
+        self.free_blocks = self.num_blocks
+        self.free_hint = 0
+        self.hasher = None
+        self.hashed_blocks = 0
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer_pool.release(self.buffer)
+            self.buffer = None
+        self.hasher = None
 
     def getBlock(self, begin, block_length):
-        return self.data[begin:block_length]
+        return memoryview(self.buffer)[begin:begin+block_length]
         
     def getEmptyBlock(self):
-        if self.complete:
+        if self.complete or not self.free_blocks:
             return None
-
-        for idx, block in enumerate(self.blocks):
+        # blocks before free_hint are never FREE, so each call resumes where the last one stopped
+        for idx in range(self.free_hint, self.num_blocks):
+            block = self.blocks[idx]
             if block.state == State.FREE:
                 block.state = State.PENDING
                 block.last_seen = time.time()
+                self.free_blocks -= 1
+                self.free_hint = idx + 1
                 return self.piece_index, idx * BLOCK_SIZE, block.size
         return None
 
+    def expireBlock(self, begin, requested_at=None):
+        # without requested_at the block is released whichever request it belongs to
+        block = self.blocks[begin // BLOCK_SIZE]
+        if block.state != State.PENDING or (requested_at is not None and block.last_seen != requested_at):
+            return False
+        block.flush()
+        self.free_blocks += 1
+        self.free_hint = min(self.free_hint, begin // BLOCK_SIZE)
+        return True
+
+    def hasFreeBlock(self):
+        return not self.complete and self.free_blocks > 0
+
+    def getPendingBlocks(self):
+        return [(self.piece_index, idx * BLOCK_SIZE, block.size) for idx, block in enumerate(self.blocks) if block.state == State.PENDING]
+
     def setBlock(self, begin, block_data, block_length):
-        block_index = math.ceil(begin / BLOCK_SIZE)
-        if self.blocks[block_index].state != State.COMPLETE and self.blocks[block_index].size == block_length:
-            self.blocks[block_index].data += block_data
-            self.blocks[block_index].state = State.COMPLETE
+        if begin % BLOCK_SIZE != 0 or begin >= self.piece_size:
+            return False
+        block = self.blocks[begin // BLOCK_SIZE]
+        if block.state != State.COMPLETE and block.size == block_length == len(block_data):
+            if block.state == State.FREE:
+                self.free_blocks -= 1
+            if self.buffer is None:
+                self.buffer = self.buffer_pool.acquire(self.piece_size)
+            memoryview(self.buffer)[begin:begin+block_length] = block_data
+            block.state = State.COMPLETE
+            self.advanceHash(INLINE_HASH_BLOCKS)
             return True
         return False
+
+    def advanceHash(self, max_blocks=None):
+        # feeds the running sha1 with the contiguous prefix of received blocks
+        if self.hasher is None:
+            self.hasher = hashlib.sha1()
+        view = memoryview(self.buffer)
+        hashed = 0
+        while self.hashed_blocks < self.num_blocks and self.blocks[self.hashed_blocks].state == State.COMPLETE:
+            if max_blocks is not None and hashed >= max_blocks:
+                break
+            begin = self.hashed_blocks * BLOCK_SIZE
+            self.hasher.update(view[begin:begin+self.blocks[self.hashed_blocks].size])
+            self.hashed_blocks += 1
+            hashed += 1
+
+    def unhashedBlocks(self):
+        return self.num_blocks - self.hashed_blocks
+
+    def finishHash(self):
+        self.advanceHash()
+        return self.hasher.digest()
     
-    def setPiece(self, data: bytes):
-        if hashlib.sha1(data).digest() != self.piece_hash:
-            print(f'PIECE: error set data hash mismatch')
-            return False
+    def setComplete(self):
         for block in self.blocks:
             if block.state != State.COMPLETE:
                 block.state = State.COMPLETE
+        self.free_blocks = 0
         self.complete = True
-        self.data = data
-        print(f'PIECE: Set Data for piece {self.piece_index} done!')
-        return True
 
-    def updateBlockStatus(self):
+    def hasAllBlocks(self):
         for block in self.blocks:
-            if block.state == State.PENDING and time.time() - block.last_seen > 5:
-                block.flush()
-
-    def isComplete(self):
-        if not self.complete:
-            for block in self.blocks:
-                if block.state != State.COMPLETE:
-                    # print(f'PIECE: piece {self.piece_index} still has uncompleted block')
-                    return False
-            data = b''.join([block.data for block in self.blocks])
-            if hashlib.sha1(data).digest() != self.piece_hash:
-                # print(f'PIECE: piece {self.piece_index} has different piece_hash')
-                self.flush()
+            if block.state != State.COMPLETE:
                 return False
-            self.complete = True
-            self.data = data
-            return True
-        else:
-            return True
\ No newline at end of file
+        return True
+
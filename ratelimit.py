@@ -0,0 +1,60 @@
+import time
+import asyncio
+from typing import Optional
+
+MIN_BURST = 2**16
+FRAGMENT_SIZE = 2**12
+
+class TokenBucket():
+    def __init__(self, rate: Optional[float] = None, burst: Optional[int] = None):
+        # rate in bytes per second, None means unlimited
+        self.setRate(rate, burst)
+        self.tokens = self.capacity
+        self.last_update = time.monotonic()
+
+    @property
+    def limited(self) -> bool:
+        return self.rate is not None
+
+    def setRate(self, rate: Optional[float], burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or (max(rate, MIN_BURST) if rate else 0)
+        if hasattr(self, 'tokens'):
+            self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def consume(self, amount: int, now: float) -> float:
+        # tokens may go negative, the debt is how long the caller waits before its bytes go out,
+        # so a sender only sleeps once it is actually over the limit
+        if not self.limited:
+            return 0.0
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter():
+    # chain of buckets (global, torrent, peer), every transfer pays into all of them
+    def __init__(self, *buckets: TokenBucket):
+        self.buckets = buckets
+
+    @property
+    def limited(self) -> bool:
+        return any(bucket.limited for bucket in self.buckets)
+
+    async def acquire(self, amount: int):
+        if not self.limited:
+            return
+        now = time.monotonic()
+        delay = max(bucket.consume(amount, now) for bucket in self.buckets)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+GLOBAL_UPLOAD = TokenBucket()
+GLOBAL_DOWNLOAD = TokenBucket()
+
+def setGlobalLimits(upload: Optional[float] = None, download: Optional[float] = None):
+    GLOBAL_UPLOAD.setRate(upload)
+    GLOBAL_DOWNLOAD.setRate(download)
@@ -0,0 +1,68 @@
+import os
+import time
+from typing import List, Dict
+from bitfield import Bitfield
+from bcoding import bencode, bdecode
+
+SAVE_INTERVAL = 5
+
+class ResumeData():
+    def __init__(self, path: str, info_hash: bytes, piece_size: int, num_pieces: int):
+        self.path = path
+        self.info_hash = info_hash
+        self.piece_size = piece_size
+        self.bitfield = Bitfield(num_pieces)
+        self.files: List[Dict] = []
+        self.last_save = 0
+
+    @staticmethod
+    def statFile(path: str) -> Dict:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {'path': path, 'length': -1, 'mtime': -1}
+        return {'path': path, 'length': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, 'rb') as f:
+                record = bdecode(f)
+        except Exception:
+            return False
+        # binary fields are stored as hex, bdecode turns any valid utf-8 byte string into str
+        if record.get('info hash') != self.info_hash.hex() or record.get('piece size') != self.piece_size:
+            print(f'RESUME: {self.path} belongs to another torrent, ignoring')
+            return False
+        bitfield = Bitfield.fromBytes(bytes.fromhex(record['bitfield']), len(self.bitfield))
+        self.bitfield = bitfield
+        self.files = record['files']
+        return True
+
+    def changedFiles(self, raw_files: List[Dict]) -> set:
+        saved = {file_info['path']: file_info for file_info in self.files}
+        changed = set()
+        for file_info in raw_files:
+            current = self.statFile(file_info['path'])
+            previous = saved.get(file_info['path'])
+            if not previous or previous['length'] != current['length'] or previous['mtime'] != current['mtime']:
+                changed.add(file_info['path'])
+        return changed
+
+    def save(self, raw_files: List[Dict]):
+        self.files = [self.statFile(file_info['path']) for file_info in raw_files]
+        record = {
+            'info hash': self.info_hash.hex(),
+            'piece size': self.piece_size,
+            'bitfield': self.bitfield.tobytes().hex(),
+            'files': self.files
+        }
+        tmp_path = self.path + '.tmp'
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode(record))
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
+    def isDue(self) -> bool:
+        return time.time() - self.last_save >= SAVE_INTERVAL
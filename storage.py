@@ -0,0 +1,198 @@
+import os
+import asyncio
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Set, Tuple
+from torrent import Torrent
+
+MAX_OPEN_FILES = 64
+
+class FileCache():
+    def __init__(self, max_open: int = MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.fds: OrderedDict = OrderedDict()
+        self.users: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path: str):
+        with self.lock:
+            fd = self.fds.get(path)
+            if fd is None:
+                try:
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                except FileNotFoundError:
+                    # directories are created lazily so skipped files never show up on disk
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                self.fds[path] = fd
+            else:
+                self.fds.move_to_end(path)
+            self.users[path] = self.users.get(path, 0) + 1
+            self.evict()
+        try:
+            yield fd
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                if not self.users[path]:
+                    del self.users[path]
+                self.evict()
+
+    def evict(self):
+        # least recently used first, descriptors still in use by a worker are skipped
+        while len(self.fds) > self.max_open:
+            for path in self.fds:
+                if path not in self.users:
+                    os.close(self.fds.pop(path))
+                    break
+            else:
+                return
+
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+
+class FileSpanIndex():
+    def __init__(self, raw_files: List[Dict], piece_size: int):
+        self.piece_size = piece_size
+        self.paths: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.offsets = array('q')
+        self.lengths = array('q')
+        offset = 0
+        for file_info in raw_files:
+            # empty files never hold piece bytes, so they are left out of the index
+            if file_info['length'] > 0:
+                self.index[file_info['path']] = len(self.paths)
+                self.paths.append(file_info['path'])
+                self.offsets.append(offset)
+                self.lengths.append(file_info['length'])
+            offset += file_info['length']
+        self.total_size = offset
+
+    def lookup(self, piece_idx: int, begin: int, length: int) -> List[Tuple[str, int, int, int]]:
+        # returns (path, file_offset, data_offset, length) for every file range covering the byte range
+        start = piece_idx * self.piece_size + begin
+        end = min(start + length, self.total_size)
+        spans = []
+        file_idx = bisect_right(self.offsets, start) - 1
+        position = start
+        while position < end and file_idx < len(self.offsets):
+            file_start = self.offsets[file_idx]
+            span_end = min(end, file_start + self.lengths[file_idx])
+            if span_end > position:
+                spans.append((self.paths[file_idx], position - file_start, position - start, span_end - position))
+                position = span_end
+            file_idx += 1
+        return spans
+
+    def pathsForPiece(self, piece_idx: int) -> Set[str]:
+        return {span[0] for span in self.lookup(piece_idx, 0, self.piece_size)}
+
+    def pieceRange(self, path: str) -> range:
+        file_idx = self.index.get(path)
+        if file_idx is None:
+            return range(0)
+        start = self.offsets[file_idx]
+        return range(start // self.piece_size, (start + self.lengths[file_idx] - 1) // self.piece_size + 1)
+
+class Storage():
+    def __init__(self, torrent: Torrent, spans: FileSpanIndex):
+        self.torrent = torrent
+        self.spans = spans
+        self.file_cache = FileCache()
+        # bytes of boundary pieces that belong to skipped files go to a sparse partfile
+        # laid out like the whole torrent, so its offsets are absolute torrent offsets
+        self.part_path = torrent.getPartPath()
+        self.skipped: Set[str] = set()
+
+    def setSkipped(self, path: str, skipped: bool):
+        if skipped:
+            self.skipped.add(path)
+        else:
+            self.skipped.discard(path)
+
+    def preallocate(self, paths=None):
+        for file_info in self.torrent.raw_files:
+            if file_info['path'] in self.skipped or (paths is not None and file_info['path'] not in paths):
+                continue
+            with self.file_cache.open(file_info['path']) as fd:
+                if os.fstat(fd).st_size != file_info['length']:
+                    os.ftruncate(fd, file_info['length'])
+
+    def target(self, path: str, file_offset: int, torrent_offset: int) -> Tuple[str, int]:
+        if path in self.skipped:
+            return self.part_path, torrent_offset
+        return path, file_offset
+
+    def blockRanges(self, piece_idx: int, begin: int, length: int) -> List[Tuple[str, int, int]]:
+        # (path, offset, length) to read for the byte range, with skipped files redirected to the partfile
+        start = piece_idx * self.spans.piece_size + begin
+        ranges = []
+        for path, file_offset, data_offset, span_length in self.spans.lookup(piece_idx, begin, length):
+            ranges.append((*self.target(path, file_offset, start + data_offset), span_length))
+        return ranges
+
+    def readBlock(self, piece_idx: int, begin: int, length: int) -> bytes:
+        buffer = []
+        for path, offset, span_length in self.blockRanges(piece_idx, begin, length):
+            with self.file_cache.open(path) as fd:
+                data = os.pread(fd, span_length, offset)
+            # a sparse partfile may end before the range, missing bytes read as zeros
+            buffer.append(data.ljust(span_length, b'\x00'))
+        return b''.join(buffer)
+
+    async def sendBlock(self, transport: asyncio.WriteTransport, piece_idx: int, begin: int, length: int):
+        # the kernel copies file ranges straight to the socket, nothing else may write to the transport meanwhile
+        loop = asyncio.get_running_loop()
+        for path, offset, span_length in self.blockRanges(piece_idx, begin, length):
+            with self.file_cache.open(path) as fd, os.fdopen(fd, 'rb', closefd=False) as file:
+                sent = await loop.sendfile(transport, file, offset, span_length)
+            if sent < span_length:
+                transport.write(bytes(span_length - sent))
+
+    def readPiece(self, piece_idx: int, piece_size: int) -> bytes:
+        return self.readBlock(piece_idx, 0, piece_size)
+
+    def writeBlock(self, piece_idx: int, begin: int, data: bytes):
+        self.writeRun(piece_idx, begin, [data])
+
+    def writePiece(self, piece_idx: int, data: bytes):
+        self.writeBlock(piece_idx, 0, data)
+
+    def writeRun(self, piece_idx: int, begin: int, buffers: List[bytes]):
+        # buffers are contiguous in torrent space, each file range gets a single pwritev
+        views = [memoryview(buffer) for buffer in buffers]
+        total = sum(len(view) for view in views)
+        start = piece_idx * self.spans.piece_size + begin
+        for path, file_offset, data_offset, span_length in self.spans.lookup(piece_idx, begin, total):
+            chunks = sliceBuffers(views, data_offset, span_length)
+            path, file_offset = self.target(path, file_offset, start + data_offset)
+            with self.file_cache.open(path) as fd:
+                while chunks:
+                    written = os.pwritev(fd, chunks, file_offset)
+                    file_offset += written
+                    chunks = sliceBuffers(chunks, written, sum(len(chunk) for chunk in chunks) - written)
+
+    def close(self):
+        self.file_cache.close()
+
+def sliceBuffers(views: List[memoryview], offset: int, length: int) -> List[memoryview]:
+    chunks = []
+    for view in views:
+        if length <= 0:
+            break
+        if offset >= len(view):
+            offset -= len(view)
+            continue
+        chunk = view[offset : offset+length]
+        chunks.append(chunk)
+        length -= len(chunk)
+        offset = 0
+    return chunks
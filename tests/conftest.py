@@ -0,0 +1,81 @@
+import os
+import sys
+import random
+import hashlib
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bcoding import bencode
+
+@pytest.fixture
+def make_torrent(tmp_path, monkeypatch):
+    # writes a multi-file torrent into a scratch directory and works from there, torrent paths are relative
+    monkeypatch.chdir(tmp_path)
+
+    def make(sizes, piece_size=32768, write=True, seed=1):
+        rnd = random.Random(seed)
+        blobs = [rnd.randbytes(size) for size in sizes]
+        full = b''.join(blobs)
+        pieces = b''.join(hashlib.sha1(full[i:i+piece_size]).digest() for i in range(0, len(full), piece_size))
+        info = {'name': 'multi', 'piece length': piece_size, 'pieces': pieces,
+                'files': [{'length': size, 'path': ['sub', f'f{idx}.bin']} for idx, size in enumerate(sizes)]}
+        with open('t.torrent', 'wb') as f:
+            f.write(bencode({'announce': 'http://127.0.0.1:1/announce', 'info': info}))
+        if write:
+            os.makedirs(os.path.join('multi', 'sub'), exist_ok=True)
+            for idx, blob in enumerate(blobs):
+                with open(os.path.join('multi', 'sub', f'f{idx}.bin'), 'wb') as f:
+                    f.write(blob)
+        return 't.torrent', blobs
+
+    return make
+
+class FakeWriter():
+    # stands in for a StreamWriter, keeps what was written or fails every write with error
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.data = bytearray()
+        self.closed = False
+        self.transport = None
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.data += data
+
+    async def drain(self):
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        return ('127.0.0.1', 6881) if name == 'peername' else default
+
+@pytest.fixture
+def peer_manager(make_torrent):
+    from torrent import Torrent
+    from piece import PieceManager
+    from peer import PeerManager
+    path, _ = make_torrent([100000, 150000], write=False)
+    return PeerManager(b'\x00' * 20, 'TESTxxxxxxxxxxxxxxxx', PieceManager(Torrent(path)), use_sendfile=False)
+
+@pytest.fixture
+def connect_peer(peer_manager):
+    # a handshaked peer on a fake connection, listed like one we dialed
+    from peer import Peer
+
+    def connect(port, writer=None, inbound=False):
+        peer = Peer(peer_manager, '127.0.0.1', port)
+        peer.writer = writer or FakeWriter()
+        peer.handshaked = True
+        peer.timeout = peer.connected_at = peer.time_span
+        (peer_manager.inbound_peers if inbound else peer_manager.peer_list).append(peer)
+        return peer
+
+    return connect
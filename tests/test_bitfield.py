@@ -0,0 +1,58 @@
+import random
+import pytest
+from bitfield import Bitfield
+
+def test_from_bytes_drops_spare_trailing_bits():
+    bitfield = Bitfield.fromBytes(b'\xff\xff', 10)
+    assert list(bitfield) == list(range(10))
+    assert bitfield.count() == 10 and bitfield.all()
+    assert bitfield.tobytes() == b'\xff\xc0'
+
+def test_from_bytes_pads_short_and_cuts_long_data():
+    short = Bitfield.fromBytes(b'\x80', 20)
+    assert list(short) == [0] and len(short.tobytes()) == 3
+    long = Bitfield.fromBytes(b'\xff' * 4, 9)
+    assert list(long) == list(range(9)) and long.tobytes() == b'\xff\x80'
+
+@pytest.mark.parametrize('other_length', [8, 20, 30])
+def test_and_not_with_mismatched_lengths(other_length):
+    mine = Bitfield.fromIndices(range(20), 20)
+    theirs = Bitfield.fromIndices(range(other_length), other_length)
+    lacking = mine.andNot(theirs)
+    assert len(lacking) == 20
+    assert list(lacking) == list(range(min(other_length, 20), 20))
+    assert lacking.count() == len(list(lacking))
+
+@pytest.mark.parametrize('other_length', [4, 10, 16])
+def test_update_with_mismatched_lengths_keeps_set_count(other_length):
+    bitfield = Bitfield.fromIndices([1, 9], 10)
+    bitfield.update(Bitfield.fromIndices(range(other_length), other_length))
+    expected = set(range(min(other_length, 10))) | {1, 9}
+    assert set(bitfield) == expected
+    assert bitfield.count() == len(expected) == bitfield.popcount()
+    # bits past our length never leak in from a longer bitfield
+    assert bitfield.tobytes()[-1] & 0x3f == 0
+    bitfield.add(9)
+    assert bitfield.count() == len(expected)
+    bitfield.discard(9)
+    assert bitfield.count() == len(expected) - 1
+
+def test_set_count_matches_the_bits_after_mixed_mutations():
+    rnd = random.Random(0)
+    bitfield = Bitfield(37)
+    model = set()
+    for _ in range(500):
+        idx = rnd.randrange(37)
+        action = rnd.randrange(3)
+        if action == 0:
+            bitfield.add(idx)
+            model.add(idx)
+        elif action == 1:
+            bitfield.discard(idx)
+            model.discard(idx)
+        else:
+            other = Bitfield.fromIndices(rnd.sample(range(37), 3), 37)
+            bitfield.update(other)
+            model |= set(other)
+        assert bitfield.count() == len(model) == bitfield.popcount()
+    assert set(bitfield) == model
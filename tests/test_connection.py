@@ -0,0 +1,22 @@
+import asyncio
+from connection import Candidate
+from conftest import FakeWriter
+
+def test_refused_dial_closes_the_socket(peer_manager, monkeypatch):
+    writer = FakeWriter()
+
+    async def connect(peer):
+        peer.writer = writer
+        peer.timeout = peer.connected_at = peer.time_span
+        return peer
+
+    monkeypatch.setattr('peer.Peer.connect', connect)
+    monkeypatch.setattr(peer_manager, 'attachPeer', lambda peer: False)
+    connections = peer_manager.connections
+    candidate = Candidate('127.0.0.1', 6881)
+    connections.candidates[('127.0.0.1', 6881)] = candidate
+    connections.dialing[('127.0.0.1', 6881)] = None
+    asyncio.run(connections.dial(candidate))
+    assert writer.closed
+    assert candidate.failures == 1
+    assert ('127.0.0.1', 6881) not in connections.dialing
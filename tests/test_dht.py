@@ -0,0 +1,24 @@
+import asyncio
+import pytest
+import dht
+
+@pytest.mark.parametrize('seed', [0, 4, 21])
+def test_loopback_swarm_finds_every_announced_peer(tmp_path, monkeypatch, seed):
+    monkeypatch.chdir(tmp_path)
+    found, found_restarted = asyncio.run(dht.simulate(seed=seed))
+    assert found == 5
+    assert found_restarted == 5
+
+@pytest.mark.parametrize('port', [70000, -1, 0, '6881'])
+def test_announce_with_a_bad_port_is_refused(port):
+    node = dht.DHTNode(b'\x01' * 20, state_path=None, bootstrap_nodes=[])
+    sent = []
+    node.send = lambda message, address: sent.append(message)
+    address = dht.PeerAddress('127.0.0.1', 6881)
+    info_hash = b'\x02' * 20
+    node.handleQuery({'q': 'announce_peer', 'a': {'id': b'\x03' * 20, 'info_hash': info_hash, 'port': port,
+                                                  'token': node.token(address.ip)}}, b'aa', address)
+    assert sent[-1]['y'] == 'e' and sent[-1]['e'][0] == dht.ERROR_PROTOCOL
+    assert node.storedPeers(info_hash) == []
+    node.handleQuery({'q': 'get_peers', 'a': {'id': b'\x03' * 20, 'info_hash': info_hash}}, b'bb', address)
+    assert sent[-1]['y'] == 'r'
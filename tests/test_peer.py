@@ -0,0 +1,146 @@
+import asyncio
+import pytest
+import messages
+import peer as peer_module
+from bitfield import Bitfield
+from conftest import FakeWriter
+
+def test_download_survives_a_dead_peer(peer_manager, connect_peer):
+    dead = connect_peer(6881, FakeWriter(ConnectionResetError('Connection lost')))
+    alive = connect_peer(6882)
+    for peer in (dead, alive):
+        peer.state['peer_choking'] = False
+        peer.have_pieces.update(Bitfield.fromIndices(range(len(peer.have_pieces)), len(peer.have_pieces)))
+        peer_manager.piece_manager.picker.addPeer(peer.have_pieces)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(peer_manager.download(), 0.3)
+
+    asyncio.run(run())
+    assert dead not in peer_manager.peer_list and dead.writer.closed
+    assert alive in peer_manager.peer_list and alive.outstanding
+
+def test_choke_state_follows_the_wire_even_when_the_peer_chokes_us(peer_manager, connect_peer):
+    peer = connect_peer(6881)
+    peer.state['peer_interested'] = True
+
+    async def run():
+        await peer_manager.rechoke()
+        assert not peer.state['am_choking'] and peer.writer.data == messages.UnChoke().writeMessage()
+        # being choked by the peer is no reason to choke it back
+        await peer.handleChoke(None)
+        await peer_manager.rechoke()
+        assert not peer.state['am_choking']
+        await peer.handleNotInterested(None)
+        await peer_manager.rechoke()
+
+    asyncio.run(run())
+    assert peer.state['am_choking']
+    assert peer.writer.data == messages.UnChoke().writeMessage() + messages.Choke().writeMessage()
+
+def test_choker_survives_a_broken_pipe(peer_manager, connect_peer, monkeypatch):
+    monkeypatch.setattr(peer_module, 'CHOKE_INTERVAL', 0.05)
+    broken = connect_peer(6881, FakeWriter(BrokenPipeError()))
+    alive = connect_peer(6882)
+    for peer in (broken, alive):
+        peer.state['peer_interested'] = True
+
+    async def run():
+        task = asyncio.create_task(peer_manager.runChoker())
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(run())
+    assert broken not in peer_manager.peer_list
+    assert not alive.state['am_choking']
+
+def test_cancel_to_a_dead_peer_removes_that_peer(peer_manager, connect_peer):
+    sender = connect_peer(6881)
+    dead = connect_peer(6882, FakeWriter(ConnectionResetError('Connection lost')))
+    for peer in (sender, dead):
+        peer_manager.trackRequest(peer, 0, 0, 16384)
+    piece = messages.Piece(0, 0, bytes(16384), 16384)
+
+    asyncio.run(peer_manager.cancelDuplicates(sender, piece))
+    assert sender in peer_manager.peer_list
+    assert dead not in peer_manager.peer_list and dead.writer.closed
+
+@pytest.mark.parametrize('idx, begin, length', [(99, 0, 16384), (-1, 0, 16384), (0, 32768 - 100, 16384), (0, 0, 0), (0, -16384, 16384), (0, 0, 2**20)])
+def test_invalid_request_disconnects(peer_manager, connect_peer, idx, begin, length):
+    peer = connect_peer(6881, inbound=True)
+    peer.state['peer_interested'] = True
+    peer.state['am_choking'] = False
+    asyncio.run(peer.handleRequest(messages.Request(idx, begin, length)))
+    assert peer not in peer_manager.inbound_peers and peer.writer.closed
+    assert not peer.upload_queue
+
+def test_valid_request_is_queued(peer_manager, connect_peer):
+    peer = connect_peer(6881, inbound=True)
+    peer.state['peer_interested'] = True
+    peer.state['am_choking'] = False
+    # the last piece of 250000 bytes is 20624 bytes long
+    asyncio.run(peer.handleRequest(messages.Request(7, 16384, 20624 - 16384)))
+    assert peer in peer_manager.inbound_peers and len(peer.upload_queue) == 1
+
+def test_send_piece_refuses_ranges_past_the_piece(make_torrent):
+    from torrent import Torrent
+    from piece import PieceManager
+    from peer import PeerManager
+    path, blobs = make_torrent([100000, 150000])
+    full = b''.join(blobs)
+    peer_manager = PeerManager(b'\x00' * 20, 'TESTxxxxxxxxxxxxxxxx', PieceManager(Torrent(path)))
+    writer = FakeWriter()
+
+    async def run():
+        assert not await peer_manager.sendPiece(writer, messages.Request(7, 16384, 16384), sendfile=True)
+        assert not writer.data
+        assert await peer_manager.sendPiece(writer, messages.Request(7, 16384, 20624 - 16384))
+
+    asyncio.run(run())
+    header = messages.Piece.writeHeader(7, 16384, 20624 - 16384)
+    assert bytes(writer.data) == header + full[7 * 32768 + 16384:]
+
+@pytest.mark.parametrize('reply', [b'', messages.Handshake('OTHERxxxxxxxxxxxxxxx', b'\x01' * 20).writeMessage()],
+                         ids=['hangs-up', 'other-torrent'])
+def test_dialed_peer_that_hangs_up_or_has_another_torrent_is_dropped(peer_manager, monkeypatch, reply):
+    # the old handler cancelled itself and read the handshake again in a loop that never yielded
+    read_handshake = peer_module.Peer.readHandshake
+    calls = []
+
+    async def readOnce(self):
+        calls.append(self)
+        assert len(calls) == 1
+        return await read_handshake(self)
+
+    monkeypatch.setattr(peer_module.Peer, 'readHandshake', readOnce)
+
+    async def answer(reader, writer):
+        writer.write(reply)
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(answer, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        peer = await peer_manager.createPeer('127.0.0.1', port).connect()
+        assert peer_manager.attachPeer(peer)
+        await asyncio.wait_for(peer.task, 2)
+        server.close()
+        return peer
+
+    peer = asyncio.run(run())
+    assert peer not in peer_manager.peer_list and peer.writer.is_closing()
+    assert not peer.handshaked
+
+def test_inbound_peer_that_fails_a_write_is_removed(peer_manager):
+    writer = FakeWriter(BrokenPipeError())
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(messages.Handshake('REMOTExxxxxxxxxxxxxx', peer_manager.info_hash).writeMessage())
+        await peer_manager.serveClientConnect(reader, writer)
+
+    asyncio.run(run())
+    assert peer_manager.inbound_peers == [] and writer.closed
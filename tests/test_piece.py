@@ -0,0 +1,136 @@
+import os
+import asyncio
+from torrent import Torrent
+from piece import PieceManager
+from picker import PRIORITY_SKIP, PRIORITY_NORMAL
+from block import BLOCK_SIZE, BufferPool
+from storage import FileSpanIndex
+
+SIZES = [100000, 150000]
+PIECE_SIZE = 32768
+
+async def receivePieces(piece_manager, full, piece_indices):
+    for idx in piece_indices:
+        piece = piece_manager.pieces[idx]
+        start = idx * PIECE_SIZE
+        for begin in range(0, piece.piece_size, BLOCK_SIZE):
+            length = min(BLOCK_SIZE, piece.piece_size - begin)
+            await piece_manager.receiveBlock(idx, begin, full[start+begin:start+begin+length], length)
+
+def readFile(idx):
+    with open(os.path.join('multi', 'sub', f'f{idx}.bin'), 'rb') as f:
+        return f.read()
+
+def test_skip_after_completion_keeps_serving_real_data(make_torrent):
+    path, blobs = make_torrent(SIZES, PIECE_SIZE)
+    full = b''.join(blobs)
+    piece_manager = PieceManager(Torrent(path))
+    assert piece_manager.isComplete()
+    piece_manager.setFilePriority(0, PRIORITY_SKIP)
+    assert piece_manager.isComplete()
+    # every piece we still advertise must read back as the torrent's bytes, now out of the partfile
+    for idx in piece_manager.bitfield:
+        piece = piece_manager.pieces[idx]
+        assert bytes(piece_manager.getBlock(idx, 0, piece.piece_size)) == full[idx*PIECE_SIZE:idx*PIECE_SIZE+piece.piece_size]
+    piece_manager.setFilePriority(0, PRIORITY_NORMAL)
+    assert readFile(0) == blobs[0]
+
+def test_unskip_after_completion_reopens_download(make_torrent):
+    path, blobs = make_torrent(SIZES, PIECE_SIZE, write=False)
+    full = b''.join(blobs)
+    piece_manager = PieceManager(Torrent(path), [PRIORITY_SKIP, PRIORITY_NORMAL])
+    reopened = []
+    piece_manager.on_reopen = lambda: reopened.append(True)
+
+    async def run():
+        writer = asyncio.create_task(piece_manager.writePiece())
+        await receivePieces(piece_manager, full, list(piece_manager.picker.wantedPieces()))
+        await asyncio.wait_for(writer, 5)
+        assert piece_manager.isComplete() and piece_manager.disk.closed
+        piece_manager.setFilePriority(0, PRIORITY_NORMAL)
+        assert reopened and not piece_manager.isComplete() and not piece_manager.disk.closed
+        writer = asyncio.create_task(piece_manager.writePiece())
+        await receivePieces(piece_manager, full, list(piece_manager.picker.wantedPieces()))
+        await asyncio.wait_for(writer, 5)
+
+    asyncio.run(run())
+    assert piece_manager.isComplete()
+    assert readFile(0) == blobs[0] and readFile(1) == blobs[1]
+
+def test_restart_after_interrupted_download_rechecks_only_saved_pieces(make_torrent, capsys):
+    path, blobs = make_torrent(SIZES, PIECE_SIZE, write=False)
+    full = b''.join(blobs)
+    piece_manager = PieceManager(Torrent(path))
+
+    async def download(piece_indices):
+        writer = asyncio.create_task(piece_manager.writePiece())
+        await receivePieces(piece_manager, full, piece_indices)
+        while not all(piece_manager.resume.bitfield[idx] for idx in piece_indices):
+            await asyncio.sleep(0.01)
+        # killed, not closed: the writer never gets to save the record
+        writer.cancel()
+
+    asyncio.run(download([0, 4]))
+    piece_manager.close()
+    asyncio.run(download([1, 5]))
+    capsys.readouterr()
+
+    restarted = PieceManager(Torrent(path))
+    # both files changed after the save, only the pieces it recorded are hashed again
+    assert 'Resumed 2 pieces, rehashed 2 pieces from 2 changed files' in capsys.readouterr().out
+    assert sorted(restarted.bitfield) == [0, 4]
+
+    restarted.close()
+    capsys.readouterr()
+    PieceManager(Torrent(path))
+    assert 'Resumed 2 pieces, rehashed 0 pieces from 0 changed files' in capsys.readouterr().out
+
+def test_buffer_pool_is_capped_by_bytes():
+    pool = BufferPool(max_bytes=3 * 1000)
+    buffers = [pool.acquire(1000) for _ in range(5)]
+    for buffer in buffers:
+        pool.release(buffer)
+    assert pool.pooled_bytes == 3000 and len(pool.buffers[1000]) == 3
+    assert pool.acquire(1000) is buffers[2] and pool.pooled_bytes == 2000
+
+def test_buffer_pool_is_emptied_once_the_download_completes(make_torrent):
+    path, blobs = make_torrent(SIZES, PIECE_SIZE, write=False)
+    piece_manager = PieceManager(Torrent(path))
+
+    async def run():
+        writer = asyncio.create_task(piece_manager.writePiece())
+        await receivePieces(piece_manager, b''.join(blobs), range(len(piece_manager.pieces)))
+        await asyncio.wait_for(writer, 5)
+
+    asyncio.run(run())
+    assert piece_manager.isComplete()
+    assert piece_manager.buffer_pool.pooled_bytes == 0 and not piece_manager.buffer_pool.buffers
+
+def spanIndex(*lengths, piece_size=64):
+    return FileSpanIndex([{'path': f'f{idx}', 'length': length} for idx, length in enumerate(lengths)], piece_size)
+
+def test_span_lookup_crosses_file_boundaries_and_skips_empty_files():
+    # f0, f2 and f4 are empty: first, middle and last
+    spans = spanIndex(0, 100, 0, 150, 0)
+    assert spans.total_size == 250
+    assert spans.lookup(0, 0, 64) == [('f1', 0, 0, 64)]
+    assert spans.lookup(1, 0, 64) == [('f1', 64, 0, 36), ('f3', 0, 36, 28)]
+    assert spans.lookup(1, 30, 10) == [('f1', 94, 0, 6), ('f3', 0, 6, 4)]
+    assert spans.pathsForPiece(1) == {'f1', 'f3'}
+
+def test_span_lookup_stops_at_the_short_last_piece():
+    spans = spanIndex(0, 100, 0, 150, 0)
+    assert spans.lookup(3, 0, 64) == [('f3', 92, 0, 58)]
+    assert spans.lookup(3, 50, 64) == [('f3', 142, 0, 8)]
+    assert spans.pathsForPiece(3) == {'f3'}
+
+def test_piece_range_for_first_last_and_empty_files():
+    spans = spanIndex(0, 100, 0, 150, 0)
+    assert spans.pieceRange('f1') == range(0, 2)
+    assert spans.pieceRange('f3') == range(1, 4)
+    for path in ('f0', 'f2', 'f4', 'missing'):
+        assert spans.pieceRange(path) == range(0)
+    # a file that ends exactly on a piece boundary does not reach into the next piece
+    aligned = spanIndex(128, 10)
+    assert aligned.pieceRange('f0') == range(0, 2)
+    assert aligned.pieceRange('f1') == range(2, 3)
@@ -0,0 +1,46 @@
+import asyncio
+import hashlib
+from bcoding import bencode
+import udptracker
+from torrent import Torrent
+from tracker import TrackerManager
+
+def writeTorrent(path, metainfo_extra):
+    info = {'name': 'single.bin', 'piece length': 32768, 'length': 1000, 'pieces': hashlib.sha1(bytes(1000)).digest()}
+    with open(path, 'wb') as f:
+        f.write(bencode({'info': info, **metainfo_extra}))
+    return path
+
+def test_single_file_torrent_announce_is_one_tier(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    torrent = Torrent(writeTorrent('a.torrent', {'announce': 'udp://127.0.0.1:6969/announce'}))
+    assert torrent.getAnnounceList() == [['udp://127.0.0.1:6969/announce']]
+    manager = TrackerManager(torrent)
+    assert [[tracker.url for tracker in tier] for tier in manager.tiers] == [['udp://127.0.0.1:6969/announce']]
+    tiers = [['udp://127.0.0.1:1'], ['http://127.0.0.1:2/announce']]
+    torrent = Torrent(writeTorrent('b.torrent', {'announce': 'udp://127.0.0.1:1', 'announce-list': tiers}))
+    assert torrent.getAnnounceList() == tiers
+    assert Torrent(writeTorrent('c.torrent', {})).getAnnounceList() == []
+
+def test_tiers_are_tried_in_order_until_one_answers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(udptracker, 'UDP_CLIENT', udptracker.UDPTrackerClient(base_timeout=0.1, max_retransmits=0))
+
+    async def run():
+        first, first_server = await udptracker.startServer()
+        second, second_server = await udptracker.startServer()
+        urls = [f'udp://127.0.0.1:{transport.get_extra_info("sockname")[1]}' for transport in (first, second)]
+        # nothing listens on the first tier
+        tiers = [['udp://127.0.0.1:9'], [urls[0]], [urls[1]]]
+        manager = TrackerManager(Torrent(writeTorrent('t.torrent', {'announce': tiers[0][0], 'announce-list': tiers})))
+        found = []
+        response = await manager.announce(on_peers=lambda peers, peer_ids: found.append(peers))
+        udptracker.UDP_CLIENT.close()
+        first.close()
+        second.close()
+        return manager, response, found, first_server, second_server
+
+    manager, response, found, first_server, second_server = asyncio.run(run())
+    assert response is not None and found == [[]]
+    assert first_server.received and not second_server.received
+    assert manager.tiers[0][0].failures == 1 and manager.event == ''
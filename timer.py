@@ -0,0 +1,26 @@
+import heapq
+import itertools
+from typing import Any, List, Tuple
+
+class RequestTimer():
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.heap: List[Tuple[float, int, Any, Any, float]] = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, key, owner, requested_at: float):
+        heapq.heappush(self.heap, (requested_at + self.timeout, next(self.counter), key, owner, requested_at))
+
+    def nextDeadline(self) -> float:
+        return self.heap[0][0] if self.heap else float('inf')
+
+    def expire(self, now: float) -> List[Tuple[Any, Any, float]]:
+        # entries are never removed early, the caller checks requested_at to skip requests that already finished
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key, owner, requested_at = heapq.heappop(self.heap)
+            expired.append((key, owner, requested_at))
+        return expired
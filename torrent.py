@@ -18,8 +18,12 @@ class Torrent():
     # GETTER
     def getAnnounce(self) -> str:
         return self.metainfo['announce']
-    def getAnnounceList(self) -> List:
-        return [self.getAnnounce()] if self.file_mode else self.metainfo.get('announce-list')
+    def getAnnounceList(self) -> List[List[str]]:
+        # tiers of tracker urls (BEP 12), a torrent without a usable announce-list has announce as its only tier
+        tiers = self.metainfo.get('announce-list')
+        if isinstance(tiers, list) and tiers and all(isinstance(tier, list) for tier in tiers):
+            return [tier for tier in tiers if tier]
+        return [[self.getAnnounce()]] if self.metainfo.get('announce') else []
     def getCreationDate(self) -> Optional[str]:
         return datetime.fromtimestamp(self.metainfo.get('creation date')) if 'creation date' in self.metainfo else None
     def getCreator(self) -> Optional[str]:
@@ -47,6 +51,10 @@ class Torrent():
         return self.metainfo['info']['length'] if self.file_mode else sum(afile["length"] for afile in self.metainfo["info"]["files"])
     def getPieceSize(self) -> int:
         return self.metainfo['info']['piece length']
+    def getResumePath(self) -> str:
+        return self.resume_file
+    def getPartPath(self) -> str:
+        return self.part_file
     
     # Construction related methods
     def decode_file(self) -> Dict:
@@ -57,23 +65,21 @@ class Torrent():
     def initialize_files(self):
         self.raw_files = []
         root = self.metainfo['info']['name']
+        # directories are created by the storage when a file is first opened
         if self.file_mode:
             root_name = os.path.splitext(self.torrent_file)[0]
-            if not os.path.exists(root_name):
-                os.mkdir(root_name)
             self.raw_files.append({'path': os.path.join(root_name, root), 'length': self.metainfo['info']['length']})
+            self.resume_file = os.path.join(root_name, root + '.resume')
+            self.part_file = os.path.join(root_name, root + '.parts')
         else:
-            if not os.path.exists(root):
-                os.mkdir(root)
+            self.resume_file = root + '.resume'
+            self.part_file = root + '.parts'
             for files in self.metainfo['info']['files']:
                 file_path = os.path.join(root, *files['path'])
-                if not os.path.exists(os.path.dirname(file_path)):
-                    os.makedirs(os.path.dirname(file_path))
                 self.raw_files.append({'path': file_path, 'length': files['length']})
 
 if __name__ == "__main__":
     tor = Torrent('sintel.torrent')
     dump(tor)
-    urls = tor.getAnnounceList()
-    for url in urls:
-        print(url)
\ No newline at end of file
+    for tier in tor.getAnnounceList():
+        print(tier)
\ No newline at end of file
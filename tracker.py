@@ -1,78 +1,155 @@
+import time
 import random
 import string
-import ipaddress
-import struct
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 import asyncio
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout
 from urllib.parse import urlencode
 from pprint import pformat
 from bcoding import bdecode
 from torrent import Torrent
-import util
+from udptracker import UDPTracker
+from address import LISTEN_PORT, PeerAddress, parsePeers, mergePeers
 
 PEER_ID = 'SISTER-' + ''.join(
     random.choice(string.ascii_lowercase + string.digits)
     for i in range(13)
 )
 
-MAX_RETRY = 2
+ANNOUNCE_TIMEOUT = 15
+TRACKER_TIMEOUT = 60
+DEFAULT_INTERVAL = 1800
+DEFAULT_MIN_INTERVAL = 60
+RETRY_BACKOFF = 60
+MAX_RETRY_BACKOFF = 3600
 
 class TrackerManager():
-    def __init__(self, torrent: Torrent):
+    def __init__(self, torrent: Torrent, counters: Callable[[], Tuple[int, int, int]] = None):
         self.torrent = torrent
         self.trackers_url = torrent.getAnnounceList()
-        self.trackers = [Tracker(url[0], self.torrent.getInfoHash(), self.torrent.getSize()) for url in self.trackers_url]
-        self.trackers_tasks = [tracker.getPeers() for tracker in self.trackers]
+        # BEP 12: trackers inside a tier are shuffled once and then tried in order
+        self.tiers: List[List] = []
+        for tier_urls in self.trackers_url:
+            tier = [tracker for tracker in (createTracker(url, torrent.getInfoHash(), self.getSession) for url in tier_urls) if tracker]
+            random.shuffle(tier)
+            if tier:
+                self.tiers.append(tier)
+        # (uploaded, downloaded, left) sent with every announce
+        self.counters = counters or (lambda: (0, 0, torrent.getSize()))
+        self.session: Optional[ClientSession] = None
         self.tracker_responses = []
-        
+        self.event = 'started'
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = DEFAULT_MIN_INTERVAL
+        self.last_announce = float('-inf')
+        self.next_announce = 0.0
+        self.wakeup = None
+
+    @property
+    def trackers(self) -> List:
+        return [tracker for tier in self.tiers for tracker in tier]
+
+    def getSession(self) -> ClientSession:
+        # one pooled session for every http tracker, connections are kept alive between announces
+        if self.session is None or self.session.closed:
+            self.session = ClientSession()
+        return self.session
+
+    async def announce(self, event: str = None, on_peers: Callable[[List[PeerAddress], Dict], None] = None) -> Optional[Dict]:
+        # BEP 12: tiers are tried in order and the first tracker that answers ends the announce,
+        # a later tier is only asked once every tracker before it failed
+        event = self.event if event is None else event
+        uploaded, downloaded, left = self.counters()
+        for tier in self.tiers:
+            response = await self.announceTier(tier, event, uploaded, downloaded, left, on_peers)
+            if response:
+                break
+        else:
+            retries = [tracker.next_retry for tracker in self.trackers]
+            self.next_announce = min(retries) if retries else time.time() + DEFAULT_INTERVAL
+            return None
+        now = time.time()
+        self.interval = response.get('interval') or DEFAULT_INTERVAL
+        self.min_interval = min(response.get('min interval') or DEFAULT_MIN_INTERVAL, self.interval)
+        self.last_announce = now
+        self.next_announce = now + self.interval
+        if event == self.event:
+            # started/completed only have to reach a tracker once, then regular announces follow
+            self.event = ''
+        self.tracker_responses = [response]
+        return response
+
+    async def announceTier(self, tier: List, event: str, uploaded: int, downloaded: int, left: int,
+                           on_peers: Callable[[List[PeerAddress], Dict], None] = None) -> Optional[Dict]:
+        # the first tracker that answers wins and moves to the front of its tier
+        now = time.time()
+        for tracker in list(tier):
+            if tracker.next_retry > now:
+                continue
+            try:
+                response = await asyncio.wait_for(tracker.announce(event, uploaded, downloaded, left), TRACKER_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f'TRACKER: announce to {tracker.url} timed out')
+                response = None
+            if not response:
+                tracker.failures += 1
+                tracker.next_retry = time.time() + min(RETRY_BACKOFF * 2 ** (tracker.failures - 1), MAX_RETRY_BACKOFF)
+                continue
+            tracker.failures = 0
+            tracker.next_retry = 0.0
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+            if on_peers:
+                on_peers(response['peers'], response.get('peer ids'))
+            return response
+        return None
+
+    def reannounce(self):
+        # asks for more peers early, but never before the trackers' min interval is up
+        self.next_announce = min(self.next_announce, self.last_announce + self.min_interval)
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self, on_peers: Callable[[List[PeerAddress], Dict], None]):
+        # peers are handed over as soon as a tracker answers
+        self.wakeup = asyncio.Event()
+        while True:
+            delay = self.next_announce - time.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.announce(on_peers=on_peers)
+
     async def requestPeers(self):
-        self.tracker_responses = []
-        for res in asyncio.as_completed(self.trackers_tasks):
-            tracker_resp = await res
-            if tracker_resp:
-                self.tracker_responses.append(tracker_resp)
-            print(f'TRACKER: tracker_response now: {self.tracker_responses}')
+        await self.announce()
+        print(f'TRACKER: tracker_response now: {self.tracker_responses}')
     
-    def getPeersOnly(self):
-        peers = []
-        for response in self.tracker_responses:
-            for peer in response['peers']:
-                peer_item = {'ip': peer['ip'], 'port': peer['port']}
-                if peer_item not in peers:
-                    peers.append(peer_item)
-        return peers
-
-    def getPeers(self):
-        peers = []
-        for response in self.tracker_responses:
-            for peer in response['peers']:
-                if not peer.get('peer id'):
-                    peer['peer id'] = '???'
-                peer_item = {'peer id': peer['peer id'], 'ip': peer['ip'], 'port': peer['port']}
-                res_idx, res = util.searchDictIdx(peers, 'ip', peer_item['ip'])
-                if res_idx == -1:
-                    peers.append(peer_item)
-                elif peer['peer id'] != '???' and res['peer id'] == '???':
-                    peers.pop(res_idx)
-                    peers.append(peer_item)
-        return peers
+    def getPeersOnly(self) -> List[PeerAddress]:
+        return mergePeers(response['peers'] for response in self.tracker_responses)
+
+    def getPeerIds(self) -> Dict[PeerAddress, str]:
+        return {address: peer_id for response in self.tracker_responses for address, peer_id in response.get('peer ids', {}).items()}
+
+    def getPeers(self) -> List[Dict]:
+        peer_ids = self.getPeerIds()
+        return [{'peer id': peer_ids.get(address, '???'), 'ip': address.ip, 'port': address.port} for address in self.getPeersOnly()]
 
     async def sendCompleted(self):
-        for tracker in self.trackers:
-            tracker.event = 'completed'
-        self.tracker_responses = []
-        tracker_tasks = [tracker.getPeers() for tracker in self.trackers]
-        for res in asyncio.as_completed(tracker_tasks):
-            tracker_resp = await res
-            if tracker_resp:
-                self.tracker_responses.append(tracker_resp)
-            # print(f'TRACKER: tracker_response now: {self.tracker_responses}')
-        else:
-            print(f'TRACKER_MAN: send complete done!')
+        self.event = 'completed'
+        await self.announce()
+        print(f'TRACKER_MAN: send complete done!')
+
+    async def close(self):
+        await self.announce('stopped')
+        if self.session:
+            await self.session.close()
     
 class Tracker():
-    def __init__(self, tracker_url: str, info_hash, size: int):
+    def __init__(self, tracker_url: str, info_hash, session_factory: Callable[[], ClientSession]):
         self.url = tracker_url
         if 'announce' not in self.url:
             if self.url[-1] == '/':
@@ -80,74 +157,50 @@ class Tracker():
             else:
                 self.url += '/announce'
         self.info_hash = info_hash
-        self.size = size
-        self.tries = 0
-        self.compact = 0
-        self.event = 'started'
+        self.session_factory = session_factory
+        self.tracker_id = None
+        self.failures = 0
+        self.next_retry = 0.0
 
-    async def getPeers(self) -> Dict:
-        tracker_response = await self.requestPeers()
-        # print(f'---TRACKER RESPONSE--- {self.url}:{self.info_hash}:{self.size}')
-        # print(tracker_response)
-        if tracker_response:
-            if isinstance(tracker_response['peers'], bytes):
-                tracker_response = self.unpackPeers(tracker_response)
-        self.event = ''
-        return tracker_response
-    
-    async def requestPeers(self) -> Optional[Dict]:
-        async with ClientSession() as session:
-            try:
-                response = await session.get(self.url + '?' + self.getTrackerParams())
+    async def announce(self, event: str, uploaded: int, downloaded: int, left: int) -> Optional[Dict]:
+        session = self.session_factory()
+        try:
+            async with session.get(self.url + '?' + self.getTrackerParams(event, uploaded, downloaded, left),
+                                   timeout=ClientTimeout(total=ANNOUNCE_TIMEOUT)) as response:
                 response_data = await response.read()
-                peers = bdecode(response_data)
-                return peers
-            except (TypeError, ValueError):
-                # print(f'TRACKER: cannot decode response from {self.url}')
-                # print(f'TRACKER: response: {response_data}')
-                self.tries += 1
-                if self.tries >= MAX_RETRY:
-                    # print(f'TRACKER: cannot connect to tracker {self.url}!')
-                    return
-                else:
-                    # print(f'TRACKER: reconnecting... from tracker {self.url} using compact mode')
-                    self.compact = 1
-                    await asyncio.sleep(2)
-                    await self.requestPeers()
-            except Exception as e:
-                # print(e)
-                # print(type(e))
-                
-                self.tries += 1
-                if self.tries == MAX_RETRY:
-                    # print(f'TRACKER: cannot connect to tracker {self.url}!')
-                    return
-                else:
-                    # print(f'TRACKER: reconnecting... from tracker {self.url} using compact mode')
-                    self.compact = 1
-                    await asyncio.sleep(2)
-                    await self.requestPeers()
+            tracker_response = bdecode(response_data)
+        except Exception as e:
+            print(f'TRACKER: announce to {self.url} failed: {type(e).__name__} {e}')
+            return None
+        if 'failure reason' in tracker_response:
+            print(f'TRACKER: {self.url} refused announce: {tracker_response["failure reason"]}')
+            return None
+        tracker_response['peers'], tracker_response['peer ids'] = parsePeers(tracker_response)
+        self.tracker_id = tracker_response.get('tracker id', self.tracker_id)
+        return tracker_response
     
-    def getTrackerParams(self) -> str:
+    def getTrackerParams(self, event: str, uploaded: int, downloaded: int, left: int) -> str:
         msg = {
             'info_hash': self.info_hash,
             'peer_id': PEER_ID,
-            'port': 52786,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.size,
-            'compact': self.compact,
-            'event': self.event
+            'port': LISTEN_PORT,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
+            'compact': 1,
+            'event': event
         }
+        if self.tracker_id:
+            msg['trackerid'] = self.tracker_id
         return urlencode(msg)
-    
-    def unpackPeers(self, raw_response: Dict) -> Dict:
-        new_response = raw_response
-        peers = raw_response['peers']
-        temp = [peers[i:i+6] for i in range(0, len(peers), 6)]
-        new_peers = [{'ip': str(ipaddress.IPv4Address(peer[:4])), 'port': struct.unpack('>H', peer[4:])[0]} for peer in temp]
-        new_response['peers'] = new_peers
-        return new_response
+
+def createTracker(tracker_url: str, info_hash, session_factory: Callable[[], ClientSession]):
+    if tracker_url.startswith('udp://'):
+        return UDPTracker(tracker_url, info_hash, PEER_ID)
+    if tracker_url.startswith(('http://', 'https://')):
+        return Tracker(tracker_url, info_hash, session_factory)
+    print(f'TRACKER: unsupported tracker {tracker_url}, skipping')
+    return None
 
 async def main(torrent):
     trackman = TrackerManager(torrent)
@@ -158,6 +211,7 @@ async def main(torrent):
     print(pformat(trackman.getPeers()))
     print('TRACKER: peers compact')
     print(pformat(trackman.getPeersOnly()))
+    await trackman.close()
 
 if __name__ == "__main__":
     from dumper import dump
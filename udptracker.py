@@ -0,0 +1,282 @@
+import time
+import random
+import socket
+import struct
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from address import LISTEN_PORT, unpackCompact
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+CONNECTION_ID_TTL = 60
+BASE_TIMEOUT = 15
+MAX_RETRANSMITS = 8
+MAX_SCRAPE_HASHES = 74
+
+CONNECT_REQUEST = struct.Struct('>QII')
+CONNECT_RESPONSE = struct.Struct('>IIQ')
+ANNOUNCE_REQUEST = struct.Struct('>QII20s20sQQQIIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('>IIIII')
+SCRAPE_REQUEST = struct.Struct('>QII')
+SCRAPE_ENTRY = struct.Struct('>III')
+RESPONSE_HEADER = struct.Struct('>II')
+COMPACT_PEER = struct.Struct('>4sH')
+
+class UDPTrackerError(Exception):
+    pass
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport: asyncio.DatagramTransport = None
+        # transaction id -> future waiting for the matching response
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < RESPONSE_HEADER.size:
+            return
+        action, transaction_id = RESPONSE_HEADER.unpack_from(data)
+        future = self.pending.pop(transaction_id, None)
+        if future and not future.done():
+            future.set_result((action, data))
+
+    def error_received(self, exc):
+        # icmp errors can't be tied to a transaction, the request just times out and is retransmitted
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(UDPTrackerError('udp socket closed'))
+        self.pending.clear()
+
+class UDPTrackerClient():
+    # a single socket serves every udp tracker, connection ids are cached per tracker for CONNECTION_ID_TTL
+    def __init__(self, base_timeout: float = BASE_TIMEOUT, max_retransmits: int = MAX_RETRANSMITS):
+        self.base_timeout = base_timeout
+        self.max_retransmits = max_retransmits
+        self.protocol: UDPTrackerProtocol = None
+        self.addresses: Dict[Tuple[str, int], Tuple[str, int]] = {}
+        self.connection_ids: Dict[Tuple[str, int], Tuple[int, float]] = {}
+
+    async def start(self):
+        if self.protocol is None or self.protocol.transport.is_closing():
+            loop = asyncio.get_running_loop()
+            _, self.protocol = await loop.create_datagram_endpoint(UDPTrackerProtocol, local_addr=('0.0.0.0', 0))
+
+    def close(self):
+        if self.protocol:
+            self.protocol.transport.close()
+            self.protocol = None
+
+    async def resolve(self, tracker: Tuple[str, int]) -> Tuple[str, int]:
+        address = self.addresses.get(tracker)
+        if address is None:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(*tracker, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = infos[0][4]
+            self.addresses[tracker] = address
+        return address
+
+    async def send(self, address: Tuple[str, int], build: Callable[[int], bytes], timeout: float) -> Tuple[int, bytes]:
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.protocol.pending:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self.protocol.pending[transaction_id] = future
+        self.protocol.transport.sendto(build(transaction_id), address)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.protocol.pending.pop(transaction_id, None)
+
+    async def connectionId(self, tracker: Tuple[str, int], address: Tuple[str, int], timeout: float) -> int:
+        cached = self.connection_ids.get(tracker)
+        if cached and time.monotonic() - cached[1] < CONNECTION_ID_TTL:
+            return cached[0]
+        action, data = await self.send(address, lambda tid: CONNECT_REQUEST.pack(PROTOCOL_ID, ACTION_CONNECT, tid), timeout)
+        if action != ACTION_CONNECT or len(data) < CONNECT_RESPONSE.size:
+            raise UDPTrackerError(self.errorMessage(data) if action == ACTION_ERROR else 'bad connect response')
+        connection_id = CONNECT_RESPONSE.unpack_from(data)[2]
+        self.connection_ids[tracker] = (connection_id, time.monotonic())
+        return connection_id
+
+    @staticmethod
+    def errorMessage(data: bytes) -> str:
+        return data[RESPONSE_HEADER.size:].decode('utf-8', 'replace')
+
+    async def request(self, tracker: Tuple[str, int], build: Callable[[int, int], bytes], expected_action: int) -> bytes:
+        # per BEP 15 an unanswered request is retransmitted after 15 * 2^n seconds, n growing up to 8;
+        # connecting counts against the same timeout so an expired connection id is simply fetched again
+        await self.start()
+        address = await self.resolve(tracker)
+        for attempt in range(self.max_retransmits + 1):
+            timeout = self.base_timeout * 2 ** attempt
+            try:
+                connection_id = await self.connectionId(tracker, address, timeout)
+                action, data = await self.send(address, lambda tid: build(connection_id, tid), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if action == ACTION_ERROR:
+                self.connection_ids.pop(tracker, None)
+                raise UDPTrackerError(self.errorMessage(data))
+            if action != expected_action:
+                raise UDPTrackerError(f'unexpected action {action}')
+            return data
+        raise UDPTrackerError(f'tracker {tracker[0]}:{tracker[1]} timed out')
+
+    async def announce(self, tracker: Tuple[str, int], info_hash: bytes, peer_id: bytes, downloaded: int = 0, left: int = 0,
+                       uploaded: int = 0, event: str = '', port: int = LISTEN_PORT, num_want: int = -1, key: int = 0) -> Dict:
+        build = lambda connection_id, tid: ANNOUNCE_REQUEST.pack(
+            connection_id, ACTION_ANNOUNCE, tid, info_hash, peer_id,
+            downloaded, left, uploaded, EVENTS.get(event, 0), 0, key, num_want, port
+        )
+        data = await self.request(tracker, build, ACTION_ANNOUNCE)
+        if len(data) < ANNOUNCE_RESPONSE.size:
+            raise UDPTrackerError('short announce response')
+        _, _, interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(data)
+        peers = unpackCompact(memoryview(data)[ANNOUNCE_RESPONSE.size:])
+        return {'interval': interval, 'incomplete': leechers, 'complete': seeders, 'peers': peers}
+
+    async def scrape(self, tracker: Tuple[str, int], info_hashes: List[bytes]) -> Dict[bytes, Dict]:
+        # a scrape carries at most 74 info hashes, bigger lists go out as several requests at once
+        batches = [info_hashes[i:i+MAX_SCRAPE_HASHES] for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES)]
+        results = await asyncio.gather(*[self.scrapeBatch(tracker, batch) for batch in batches])
+        return {info_hash: stats for result in results for info_hash, stats in result.items()}
+
+    async def scrapeBatch(self, tracker: Tuple[str, int], info_hashes: List[bytes]) -> Dict[bytes, Dict]:
+        build = lambda connection_id, tid: SCRAPE_REQUEST.pack(connection_id, ACTION_SCRAPE, tid) + b''.join(info_hashes)
+        data = await self.request(tracker, build, ACTION_SCRAPE)
+        stats = {}
+        entries = SCRAPE_ENTRY.iter_unpack(memoryview(data)[RESPONSE_HEADER.size:RESPONSE_HEADER.size + SCRAPE_ENTRY.size * len(info_hashes)])
+        for info_hash, (seeders, completed, leechers) in zip(info_hashes, entries):
+            stats[info_hash] = {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+        return stats
+
+UDP_CLIENT = UDPTrackerClient()
+
+class UDPTracker():
+    def __init__(self, tracker_url: str, info_hash: bytes, peer_id, client: UDPTrackerClient = None):
+        self.url = tracker_url
+        parsed = urlparse(tracker_url)
+        self.address = (parsed.hostname, parsed.port or 80)
+        self.info_hash = info_hash
+        self.peer_id = peer_id.encode() if isinstance(peer_id, str) else peer_id
+        self.client = client or UDP_CLIENT
+        self.key = random.getrandbits(32)
+        self.failures = 0
+        self.next_retry = 0.0
+
+    async def announce(self, event: str, uploaded: int, downloaded: int, left: int, port: int = LISTEN_PORT) -> Optional[Dict]:
+        try:
+            return await self.client.announce(self.address, self.info_hash, self.peer_id, downloaded=downloaded, left=left,
+                                              uploaded=uploaded, event=event, port=port, key=self.key)
+        except (UDPTrackerError, OSError) as e:
+            print(f'TRACKER: udp announce to {self.url} failed: {e}')
+            return None
+
+    async def scrape(self) -> Optional[Dict]:
+        try:
+            return (await self.client.scrape(self.address, [self.info_hash])).get(self.info_hash)
+        except (UDPTrackerError, OSError) as e:
+            print(f'TRACKER: udp scrape to {self.url} failed: {e}')
+            return None
+
+class UDPTrackerServer(asyncio.DatagramProtocol):
+    # minimal in-memory BEP 15 tracker for local runs, drop_first swallows requests to exercise retransmits
+    def __init__(self, interval: int = 1800, drop_first: int = 0):
+        self.interval = interval
+        self.drop_first = drop_first
+        self.transport = None
+        self.connection_ids: Dict[int, float] = {}
+        # info hash -> (ip, port) -> bytes left
+        self.swarms: Dict[bytes, Dict[Tuple[str, int], int]] = {}
+        self.completed: Dict[bytes, int] = {}
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error(self, transaction_id: int, message: str, addr):
+        self.transport.sendto(RESPONSE_HEADER.pack(ACTION_ERROR, transaction_id) + message.encode(), addr)
+
+    def datagram_received(self, data: bytes, addr):
+        self.received += 1
+        if self.drop_first > 0:
+            self.drop_first -= 1
+            return
+        if len(data) < CONNECT_REQUEST.size:
+            return
+        connection_id, action, transaction_id = CONNECT_REQUEST.unpack_from(data)
+        if action == ACTION_CONNECT:
+            if connection_id != PROTOCOL_ID:
+                return
+            new_id = random.getrandbits(64)
+            self.connection_ids[new_id] = time.monotonic()
+            self.transport.sendto(CONNECT_RESPONSE.pack(ACTION_CONNECT, transaction_id, new_id), addr)
+        elif time.monotonic() - self.connection_ids.get(connection_id, float('-inf')) > 2 * CONNECTION_ID_TTL:
+            self.error(transaction_id, 'connection id expired', addr)
+        elif action == ACTION_ANNOUNCE and len(data) >= ANNOUNCE_REQUEST.size:
+            self.announce(data, transaction_id, addr)
+        elif action == ACTION_SCRAPE:
+            info_hashes = [data[i:i+20] for i in range(SCRAPE_REQUEST.size, len(data) - 19, 20)][:MAX_SCRAPE_HASHES]
+            response = RESPONSE_HEADER.pack(ACTION_SCRAPE, transaction_id)
+            for info_hash in info_hashes:
+                swarm = self.swarms.get(info_hash, {})
+                seeders = sum(1 for left in swarm.values() if not left)
+                response += SCRAPE_ENTRY.pack(seeders, self.completed.get(info_hash, 0), len(swarm) - seeders)
+            self.transport.sendto(response, addr)
+        else:
+            self.error(transaction_id, 'unsupported action', addr)
+
+    def announce(self, data: bytes, transaction_id: int, addr):
+        fields = ANNOUNCE_REQUEST.unpack_from(data)
+        info_hash, left, event, num_want, port = fields[3], fields[6], fields[8], fields[11], fields[12]
+        swarm = self.swarms.setdefault(info_hash, {})
+        peer = (addr[0], port)
+        if event == EVENTS['stopped']:
+            swarm.pop(peer, None)
+        else:
+            swarm[peer] = left
+        if event == EVENTS['completed']:
+            self.completed[info_hash] = self.completed.get(info_hash, 0) + 1
+        others = [other for other in swarm if other != peer]
+        others = others[:num_want if num_want >= 0 else 50]
+        seeders = sum(1 for peer_left in swarm.values() if not peer_left)
+        response = ANNOUNCE_RESPONSE.pack(ACTION_ANNOUNCE, transaction_id, self.interval, len(swarm) - seeders, seeders)
+        response += b''.join(COMPACT_PEER.pack(socket.inet_aton(ip), port) for ip, port in others)
+        self.transport.sendto(response, addr)
+
+async def startServer(host: str = '127.0.0.1', port: int = 0, **kwargs) -> Tuple[asyncio.DatagramTransport, UDPTrackerServer]:
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(lambda: UDPTrackerServer(**kwargs), local_addr=(host, port))
+
+async def demo():
+    transport, server = await startServer(drop_first=1)
+    host, port = transport.get_extra_info('sockname')
+    tracker = (host, port)
+    client = UDPTrackerClient(base_timeout=0.2)
+    info_hash = bytes(range(20))
+    start = time.perf_counter()
+    for peer_port in (6881, 6882, 6883):
+        response = await client.announce(tracker, info_hash, b'-SISTER-' + bytes(12), left=peer_port % 2, event='started', port=peer_port)
+    elapsed = time.perf_counter() - start
+    print(f'UDP_TRACKER: 3 announces in {elapsed * 1e3:.1f}ms (first request dropped and retransmitted), {server.received} datagrams')
+    print(f'UDP_TRACKER: last announce saw {response["peers"]} seeders={response["complete"]} leechers={response["incomplete"]}')
+    info_hashes = [info_hash] + [random.getrandbits(160).to_bytes(20, 'big') for _ in range(99)]
+    received = server.received
+    stats = await client.scrape(tracker, info_hashes)
+    print(f'UDP_TRACKER: scraped {len(stats)} torrents with {server.received - received} datagrams, ours {stats[info_hash]}')
+    client.close()
+    transport.close()
+
+if __name__ == "__main__":
+    asyncio.run(demo())
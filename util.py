@@ -1,6 +1,23 @@
-def searchDictIdx(a_list: list, key, value):
-    for idx, x in enumerate(a_list):
-        if x[key] == value:
-            return idx, x
-    else:
-        return -1, None
\ No newline at end of file
+import math
+import time
+
+class RateMeter():
+    def __init__(self, window=5.0):
+        self.window = window
+        self.rate = 0.0
+        self.total = 0
+        self.last_update = time.time()
+
+    def decay(self):
+        now = time.time()
+        self.rate *= math.exp(-(now - self.last_update) / self.window)
+        self.last_update = now
+
+    def add(self, amount: int):
+        self.decay()
+        self.rate += amount / self.window
+        self.total += amount
+
+    def getRate(self) -> float:
+        self.decay()
+        return self.rate
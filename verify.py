@@ -0,0 +1,79 @@
+import os
+import time
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple
+
+MAX_WORKERS = os.cpu_count() or 1
+
+def hashMatches(data: bytes, piece_hash: bytes) -> bool:
+    return hashlib.sha1(data).digest() == piece_hash
+
+class HashVerifier():
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='verify')
+
+    async def verify(self, data: bytes, piece_hash: bytes) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, hashMatches, data, piece_hash)
+
+    async def verifyTail(self, piece) -> bool:
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(self.executor, piece.finishHash)
+        return digest == piece.piece_hash
+
+    def checkPiece(self, piece, read_piece: Callable[[int, int], bytes]) -> bool:
+        try:
+            data = read_piece(piece.piece_index, piece.piece_size)
+        except OSError:
+            return False
+        return hashMatches(data, piece.piece_hash)
+
+    def recheck(self, pieces: Iterable, read_piece: Callable[[int, int], bytes]) -> Iterator[Tuple[object, bool]]:
+        # pieces are read inside the workers, so at most max_workers pieces are held in memory at once
+        pieces = list(pieces)
+        results = self.executor.map(lambda piece: self.checkPiece(piece, read_piece), pieces)
+        return zip(pieces, results)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+def benchmark(total_size: int = 129302391, piece_size: int = 2**17, path: str = 'verify_benchmark.tmp'):
+    num_pieces = (total_size + piece_size - 1) // piece_size
+
+    class BenchPiece():
+        def __init__(self, piece_index, piece_hash, piece_size):
+            self.piece_index = piece_index
+            self.piece_hash = piece_hash
+            self.piece_size = piece_size
+
+    pieces = []
+    with open(path, 'wb') as f:
+        for idx in range(num_pieces):
+            data = os.urandom(min(piece_size, total_size - idx * piece_size))
+            f.write(data)
+            pieces.append(BenchPiece(idx, hashlib.sha1(data).digest(), len(data)))
+    fd = os.open(path, os.O_RDONLY)
+    read_piece = lambda idx, size: os.pread(fd, size, idx * piece_size)
+    try:
+        start = time.perf_counter()
+        serial_ok = sum(hashMatches(read_piece(p.piece_index, p.piece_size), p.piece_hash) for p in pieces)
+        serial_time = time.perf_counter() - start
+
+        verifier = HashVerifier()
+        start = time.perf_counter()
+        pool_ok = sum(ok for _, ok in verifier.recheck(pieces, read_piece))
+        pool_time = time.perf_counter() - start
+        verifier.shutdown()
+    finally:
+        os.close(fd)
+        os.remove(path)
+    size_mb = total_size / (1024 * 1024)
+    print(f'VERIFY: {num_pieces} pieces, {size_mb:.2f}MB, {MAX_WORKERS} workers')
+    print(f'VERIFY: serial {serial_time:.3f}s ({size_mb / serial_time:.1f}MB/s) ok={serial_ok}')
+    print(f'VERIFY: pool   {pool_time:.3f}s ({size_mb / pool_time:.1f}MB/s) ok={pool_ok}')
+
+if __name__ == "__main__":
+    benchmark()